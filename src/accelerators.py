@@ -0,0 +1,32 @@
+from hittable import Hittable, HittableList, Sphere, SphereSet
+from bvh import BVH
+
+# Above this many spheres, 'auto' prefers a BVH to a brute force SphereSet
+AUTO_SPHERESET_MAX = 64
+
+def auto(objects):
+    '''Pick the structure best suited to the scene'''
+    objects = list(objects)
+    if not all(isinstance(x, Sphere) for x in objects):
+        return HittableList(objects)
+    if len(objects) <= AUTO_SPHERESET_MAX:
+        return SphereSet(objects)
+    return BVH(objects)
+
+# Structures a list of hittables can be compiled into before rendering
+ACCELERATORS = {
+    'auto': auto,
+    'list': HittableList,
+    'sphereset': SphereSet,
+    'bvh': BVH,
+}
+
+def build_world(objects, accelerator='auto'):
+    '''Compile a scene (a list of hittables) into a single Hittable.
+
+    Hittables are returned unchanged, so an already built world can be
+    passed around and rendered several times.
+    '''
+    if isinstance(objects, Hittable):
+        return objects
+    return ACCELERATORS[accelerator](objects)
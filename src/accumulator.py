@@ -0,0 +1,228 @@
+import os
+import json
+import numpy as np
+from collections import namedtuple
+from vec3 import Vec3, PackedVec3, get_layout
+
+# A batch of samples to trace: n_samples rays through each of the pixels
+# (a slice or an array of flat pixel indices). key is the tile and first
+# sample index of the batch, which identify the random streams it draws
+# from.
+WorkUnit = namedtuple('WorkUnit', 'key pixels n_samples')
+
+def unit_size(pixels):
+    '''Number of pixels of the pixels of a WorkUnit'''
+    if isinstance(pixels, slice):
+        return pixels.stop - pixels.start
+    return len(pixels)
+
+def split_units(units, unit_samples):
+    '''The units split into ranges of at most unit_samples samples, each
+    keyed by its tile and first sample'''
+    if not unit_samples or unit_samples <= 0:
+        return list(units)
+    return [WorkUnit((unit.key[0], first), unit.pixels, min(unit_samples, unit.key[1] + unit.n_samples - first))
+            for unit in units
+            for first in range(unit.key[1], unit.key[1] + unit.n_samples, unit_samples)]
+
+class Accumulator:
+    '''Running per-pixel statistics of a render.
+
+    Keeps the sum of the sampled colors, the sum of their squares and the
+    number of samples of every pixel: enough to get the mean color
+    and an estimate of its noise at any point of the render. The arrays can
+    live in a caller provided buffer (e.g. shared memory or a memory-mapped
+    file, see create()) laid out as described by nbytes(). The sums are
+    stored in the Vec3 layout active when the accumulator is created, so
+    that image() hands a packed vector straight to the image conversion;
+    every process sharing a buffer must use the same layout.
+    '''
+    def __init__(self, n_pixels, buffer=None):
+        self.n_pixels = n_pixels
+        if buffer is None:
+            buffer = bytearray(self.nbytes(n_pixels))
+
+        offset = 0
+        if get_layout() == 'packed':
+            sums = np.ndarray((n_pixels, 3), dtype=np.float32, buffer=buffer, offset=offset)
+            self.sum = PackedVec3(sums)
+        else:
+            sums = np.ndarray((3, n_pixels), dtype=np.float32, buffer=buffer, offset=offset)
+            self.sum = Vec3.wrap(sums[0], sums[1], sums[2])
+        offset += sums.nbytes
+        # float64: the variance is a difference of large, close sums
+        self.sum_sq = np.ndarray((3, n_pixels), dtype=np.float64, buffer=buffer, offset=offset)
+        offset += self.sum_sq.nbytes
+        self.count = np.ndarray(n_pixels, dtype=np.int32, buffer=buffer, offset=offset)
+        self._buffer = buffer
+
+    def flush(self):
+        '''Write the buffers of a memory-mapped accumulator to its file'''
+        if isinstance(self._buffer, np.memmap):
+            self._buffer.flush()
+
+    @staticmethod
+    def nbytes(n_pixels):
+        return n_pixels * (3*4 + 3*8 + 4)
+
+    @classmethod
+    def create(cls, path, n_pixels):
+        '''An empty accumulator memory-mapped to a new .npy file of raw bytes.
+
+        The operating system pages the buffers in and out as needed, so the
+        frame can be larger than the memory, and the file outlives the
+        process.
+        '''
+        buffer = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8,
+                                           shape=(cls.nbytes(n_pixels),))
+        return cls(n_pixels, buffer=buffer)
+
+    @classmethod
+    def for_settings(cls, settings, buffer=None):
+        '''An empty accumulator of the frame of settings, memory-mapped to
+        settings.accumulator_file when given, else in buffer (allocated
+        when None)'''
+        n_pixels = settings.width * settings.height
+        if settings.accumulator_file:
+            return cls.create(settings.accumulator_file, n_pixels)
+        return cls(n_pixels, buffer=buffer)
+
+    @classmethod
+    def open(cls, path, n_pixels):
+        '''An accumulator memory-mapped to an existing file from create()'''
+        buffer = np.load(path, mmap_mode='r+')
+        if buffer.size != cls.nbytes(n_pixels):
+            raise ValueError('%s does not hold the accumulator of %d pixels' % (path, n_pixels))
+        return cls(n_pixels, buffer=buffer)
+
+    def add(self, pixels, colors):
+        '''Add one sample for each of the pixels'''
+        self.sum[pixels] += colors
+        squares = colors.join().astype(np.float64)
+        squares *= squares
+        self.sum_sq[:, pixels] += squares
+        self.count[pixels] += 1
+
+    def add_at(self, pixels, colors):
+        '''Add one sample for each of the pixels, which may repeat (samples
+        of the same pixel traced together)'''
+        np.add.at(self.sum.x, pixels, colors.x)
+        np.add.at(self.sum.y, pixels, colors.y)
+        np.add.at(self.sum.z, pixels, colors.z)
+        squares = colors.join().astype(np.float64)
+        squares *= squares
+        for channel in range(3):
+            np.add.at(self.sum_sq[channel], pixels, squares[channel])
+        np.add.at(self.count, pixels, 1)
+
+    def samples(self):
+        return int(self.count.sum())
+
+    def mean(self, pixels=slice(None)):
+        return self.sum[pixels] / np.maximum(self.count[pixels], 1)
+
+    def variance(self):
+        '''Unbiased variance of the samples of each pixel, per channel (3xN)'''
+        n = self.count.astype(np.float64)
+        mean = self.sum.join().astype(np.float64) / np.maximum(n, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = (self.sum_sq - n*mean*mean) / (n - 1)
+        return np.where(n > 1, np.maximum(var, 0.0), np.inf)
+
+    def std_error(self):
+        '''Standard error of the mean color of each pixel, per channel (3xN)'''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(self.variance() / np.maximum(self.count, 1))
+
+    def noise(self):
+        '''Estimated error of each pixel once gamma corrected.
+
+        The standard error of the mean color, carried through the sqrt()
+        gamma curve so that dark pixels (where the curve is steep) are not
+        under-sampled, and taken on the worst channel.
+        '''
+        mean = self.sum.join().astype(np.float64) / np.maximum(self.count, 1)
+        return (self.std_error() / (2*np.sqrt(np.maximum(mean, 1e-3)))).max(axis=0)
+
+    def unconverged(self, threshold, min_samples=2):
+        '''Boolean mask of the pixels still noisier than threshold'''
+        return np.logical_or(self.count < min_samples, self.noise() >= threshold)
+
+    def image(self, apply_gamma=True, pixels=slice(None)):
+        '''Mean color of the pixels (all by default), clipped to [0, 1)'''
+        img = self.mean(pixels)
+        if apply_gamma:
+            np.sqrt(img.x, out=img.x)
+            np.sqrt(img.y, out=img.y)
+            np.sqrt(img.z, out=img.z)
+        return img.clip(0.0, 0.999)
+
+    def merge(self, other, pixels=slice(None)):
+        '''Add the samples of another accumulator of the same frame, e.g.
+        from an independent run with another seed, or of the given pixels
+        of the frame only (other then holds those pixels, in order)'''
+        n_pixels = self.count[pixels].size
+        if other.n_pixels != n_pixels:
+            raise ValueError('cannot merge accumulators of %d and %d pixels'
+                             % (n_pixels, other.n_pixels))
+        self.sum[pixels] += other.sum
+        self.sum_sq[:, pixels] += other.sum_sq
+        self.count[pixels] += other.count
+
+    def save(self, path, **metadata):
+        '''Save the statistics and the metadata given (JSON types) to an
+        .npz file. The file is replaced atomically, a crash while saving
+        leaves the previous one intact.'''
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, sum=self.sum.join(), sum_sq=self.sum_sq, count=self.count,
+                     metadata=json.dumps(metadata))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        '''The accumulator and the metadata saved by save()'''
+        with np.load(path) as data:
+            count = data['count']
+            accumulator = cls(count.size)
+            accumulator.sum[:] = Vec3(*data['sum'])
+            accumulator.sum_sq[:] = data['sum_sq']
+            accumulator.count[:] = count
+            metadata = json.loads(str(data['metadata']))
+        return accumulator, metadata
+
+    def copy(self):
+        other = Accumulator(self.n_pixels)
+        other.sum[:] = self.sum
+        other.sum_sq[:] = self.sum_sq
+        other.count[:] = self.count
+        return other
+
+
+class Engine:
+    '''Base of the render engines (see renderer.ENGINES), which trace work
+    units into the accumulator of the frame: run(units, on_unit) renders
+    the units and calls on_unit(unit) as each completes, and close() ends
+    the render and leaves the result in accumulator.'''
+    def __init__(self, settings, buffer=None):
+        self.accumulator = Accumulator.for_settings(settings, buffer)
+
+    def run(self, units, on_unit=None):
+        raise NotImplementedError()
+
+    def close(self):
+        self.accumulator.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class UnitAccumulator(Accumulator):
+    '''The statistics of the pixels of one work unit only, in their order,
+    to merge() into the frame's accumulator: Renderer._render_unit adds the
+    samples of the whole unit at once'''
+    def add(self, pixels, colors):
+        super().add(slice(None), colors)
@@ -0,0 +1,161 @@
+'''Render a sequence of frames of one scene.
+
+A job file (JSON, or YAML when PyYAML is installed) gives the scene, the
+shader, the settings shared by all the frames and the frames themselves,
+each a set of settings overriding the shared ones:
+
+    {
+        "scene": "world3",
+        "shader": "color_materials",
+        "settings": {"width": 200, "samples_per_pixel": 16, "seed": 1},
+        "frames": [
+            {"camera_origin": [0, 0, 0]},
+            {"camera_origin": [0, 0.5, 0], "camera_look_at": [0, 0, -1]}
+        ],
+        "output": "images/batch",
+        "pattern": "frame_%04d.png"
+    }
+
+Instead of "frames", a "turntable" entry orbits the camera around a point:
+
+    "turntable": {"frames": 36, "look_at": [0, 0, -1], "radius": 1, "height": 0.5}
+
+The scene is compiled once and stays resident for the whole sequence, so a
+frame costs little more than its trace time. Frames are rendered one after
+the other, or with --frame-workers on a pool of processes that each keep
+their own copy of the scene.
+
+    python batch.py job.json [--frame-workers N]
+'''
+import os
+import json
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from settings import Settings
+from renderer import Renderer
+from scenes import Scenes
+from color_types import Colors
+from accelerators import build_world
+
+OUTPUT = os.path.join('images', 'batch')
+PATTERN = 'frame_%04d.png'
+
+def load_job(path):
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError('PyYAML is needed to read %s, use a JSON job file instead' % path)
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def turntable(frames, look_at=(0, 0, -1), radius=1.0, height=0.0):
+    '''Camera overrides of a full orbit around look_at, in the xz plane'''
+    for i in range(frames):
+        theta = 2 * np.pi * i / frames
+        origin = [look_at[0] + radius * np.sin(theta),
+                  look_at[1] + height,
+                  look_at[2] + radius * np.cos(theta)]
+        yield {'camera_origin': origin, 'camera_look_at': list(look_at)}
+
+def frame_settings(job):
+    '''Settings of each frame of the job, in order'''
+    base = job.get('settings', {})
+    if 'turntable' in job:
+        frames = turntable(**job['turntable'])
+    else:
+        frames = job.get('frames', [{}])
+    for overrides in frames:
+        yield Settings.from_dict(dict(base, **overrides))
+
+class Batch:
+    '''Renders frames of one scene, compiled once.
+
+    The compiled worlds are cached per accelerator, so that frames that
+    only move the camera or change the sampling settings reuse them.
+    '''
+    def __init__(self, scene, ray_color):
+        self.scene = scene
+        self.ray_color = ray_color
+        self._worlds = {}
+
+    def world(self, accelerator):
+        world = self._worlds.get(accelerator)
+        if world is None:
+            world = build_world(self.scene, accelerator)
+            self._worlds[accelerator] = world
+        return world
+
+    def render(self, settings):
+        renderer = Renderer(settings)
+        return renderer.render(self.world(settings.accelerator), self.ray_color)
+
+# Per-process Batch of the frame workers, set up once by _init_worker
+_batch = None
+
+def _init_worker(batch):
+    global _batch
+    _batch = batch
+
+def _render_frame(settings):
+    image = _batch.render(settings)
+    return image.tobytes(), image.mode, image.size
+
+def run(job, frame_workers=1, quiet=False):
+    '''Render all the frames of the job, returns the paths of the images'''
+    output = job.get('output', OUTPUT)
+    pattern = job.get('pattern', PATTERN)
+    os.makedirs(output, exist_ok=True)
+
+    batch = Batch(Scenes[job.get('scene', 'world3')].value.build(),
+                  Colors[job.get('shader', 'color_materials')].value.function)
+    frames = list(frame_settings(job))
+    for settings in frames:
+        settings.progress = False
+        if frame_workers > 1:
+            # Frames are the unit of parallelism, not tiles
+            settings.workers = 1
+    # Compile the worlds once, the frame workers receive them ready to use
+    for accelerator in dict.fromkeys(s.accelerator for s in frames):
+        batch.world(accelerator)
+
+    def save(i, image, started):
+        path = os.path.join(output, pattern % i)
+        image.save(path)
+        if not quiet:
+            print('frame %d/%d: %s (%.2fs)' % (i + 1, len(frames), path, time.time() - started))
+        return path
+
+    paths = []
+    started = time.time()
+    if frame_workers > 1:
+        from PIL import Image
+        with ProcessPoolExecutor(frame_workers, initializer=_init_worker, initargs=(batch,)) as pool:
+            for i, (data, mode, size) in enumerate(pool.map(_render_frame, frames)):
+                paths.append(save(i, Image.frombytes(mode, size, data), started))
+                started = time.time()
+    else:
+        for i, settings in enumerate(frames):
+            paths.append(save(i, batch.render(settings), started))
+            started = time.time()
+    return paths
+
+def get_command_line_args():
+    parser = ArgumentParser(description='Render the frames of a job file')
+    parser.add_argument('job', type=str, help='JSON (or YAML) job file')
+    parser.add_argument('--frame-workers', type=int, help='number of processes rendering frames in parallel (default 1)', default=1)
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not report the frames as they are saved')
+    return parser.parse_args()
+
+def main():
+    np.seterr(invalid='ignore')
+    args = get_command_line_args()
+    run(load_job(args.job), args.frame_workers, args.quiet)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+'''Rendering benchmarks.
+
+Times the hot stages of the renderer (sphere intersection, random
+sampling, material scattering, full renders and image conversion) and the
+startup of the command line tools, and reports their throughput and peak
+memory. Results can be saved as a JSON baseline and later runs compared
+against it:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+'''
+import os
+import re
+import sys
+import json
+import time
+import platform
+import subprocess
+import tracemalloc
+from argparse import ArgumentParser
+from collections import namedtuple
+
+import numpy as np
+
+from settings import Settings
+from renderer import Renderer
+from scenes import Scenes
+from accelerators import build_world
+from color import color_materials
+from hittable import HitRecord, Sphere
+from material import Lambertian, Metal
+from helpers import random_in_unit_sphere
+import sampling
+from ray import Ray
+from vec3 import Vec3, Point3, Color
+
+# name: benchmark name
+# setup: function returning the function to time, called once per benchmark
+# items: amount of work done by one call (rays, samples or pixels)
+# unit: what items counts
+Benchmark = namedtuple('Benchmark', 'name setup items unit')
+
+# Slower than the baseline by more than this fraction is a regression
+TOLERANCE = 0.15
+
+def _random_rays(n, seed=0):
+    rng = np.random.RandomState(seed)
+    origin = Vec3.zeros(n)
+    direction = Vec3(rng.uniform(-1, 1, n), rng.uniform(-1, 1, n), -np.ones(n))
+    return Ray(origin, direction)
+
+def _hits(n):
+    # n rays that hit world3, with their hit records, as a material sees them
+    rays = _random_rays(4 * n)
+    rec = HitRecord(len(rays))
+    build_world(Scenes.world3.value.build()).update_hit_record(rays, 0.001, np.inf, rec)
+    hits = np.flatnonzero(rec.t != np.inf)[:n]
+    return rays[hits], rec[hits]
+
+def sphere_hit(n):
+    def setup():
+        rays = _random_rays(n)
+        sphere = Sphere(Point3(0, 0, -1), 0.5, None)
+        rec = HitRecord(n)
+        def run():
+            rec.t.fill(np.inf)
+            sphere.update_hit_record(rays, 0.001, np.inf, rec)
+        return run
+    return Benchmark('sphere_hit_%d' % n, setup, n, 'rays')
+
+def unit_sphere(n):
+    def setup():
+        return lambda: random_in_unit_sphere(n)
+    return Benchmark('random_in_unit_sphere_%d' % n, setup, n, 'samples')
+
+def scatter(material, n):
+    def setup():
+        rays, rec = _hits(n)
+        return lambda: material.scatter(rays, rec)
+    return Benchmark('scatter_%s_%d' % (type(material).__name__.lower(), n), setup, n, 'rays')
+
+def render(scene, width, max_depth, samples=1, engine='passes'):
+    settings = Settings(width=width, samples_per_pixel=samples, max_depth=max_depth,
+                        seed=0, progress=False, engine=engine)
+    def setup():
+        renderer = Renderer(settings)
+        world = build_world(scene.value.build(), settings.accelerator)
+        return lambda: renderer._compute_image(world, color_materials)
+    name = 'render_%s_w%d_d%d' % (scene.name, width, max_depth)
+    if samples > 1:
+        name += '_p%d' % samples
+    if engine != 'passes':
+        name += '_' + engine
+    return Benchmark(name, setup,
+                     settings.width * settings.height * samples, 'rays')
+
+def convert_to_pil(width):
+    settings = Settings(width=width, progress=False)
+    def setup():
+        renderer = Renderer(settings)
+        n = settings.width * settings.height
+        colors = Vec3(*np.random.RandomState(0).uniform(0, 1, (3, n)))
+        return lambda: renderer._convert_to_pil(colors)
+    return Benchmark('convert_to_pil_w%d' % width, setup,
+                     settings.width * settings.height, 'pixels')
+
+def startup(module):
+    # A fresh interpreter importing the module: what every command line
+    # render pays before tracing its first ray
+    command = [sys.executable, '-c', 'import %s' % module]
+    def setup():
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        return lambda: subprocess.run(command, cwd=cwd, check=True)
+    return Benchmark('startup_%s' % module, setup, 1, 'starts')
+
+def benchmarks(quick=False):
+    n = 10000 if quick else 100000
+    widths = (100,) if quick else (100, 200, 400)
+    depths = (5,) if quick else (5, 50)
+    suite = [
+        sphere_hit(n),
+        unit_sphere(n),
+        scatter(Lambertian(Color(0.5, 0.5, 0.5)), n),
+        scatter(Metal(Color(0.8, 0.8, 0.8), 0.3), n),
+    ]
+    for scene in (Scenes.world1, Scenes.world2, Scenes.world3):
+        for width in widths:
+            for depth in depths:
+                suite.append(render(scene, width, depth))
+    # Several samples per pixel, where the wavefront engine keeps its pool
+    # full while the passes shrink bounce after bounce
+    for engine in ('passes', 'wavefront'):
+        suite.append(render(Scenes.world3, widths[0], depths[-1], 8, engine))
+    suite.append(convert_to_pil(widths[-1]))
+    suite.append(startup('main'))
+    suite.append(startup('batch'))
+    return suite
+
+def measure(benchmark, repeat=3):
+    '''Best time of repeat calls, and the peak memory of one call'''
+    sampling.seed(0)
+    run = benchmark.setup()
+    run()   # warm up caches and scratch buffers
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t0)
+
+    # tracemalloc slows things down: measure memory in a separate call
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(times)
+    return {
+        'seconds': best,
+        'items': benchmark.items,
+        'unit': benchmark.unit,
+        'per_second': benchmark.items / best,
+        'peak_bytes': peak,
+    }
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    '''Names of the benchmarks that regressed against the baseline.
+
+    A benchmark regresses when its throughput drops, or its peak memory
+    grows, by more than tolerance.
+    '''
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['per_second'] < base['per_second'] * (1 - tolerance):
+            regressions.append(name)
+        elif result['peak_bytes'] > base['peak_bytes'] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+def print_table(results, baseline=None, regressions=()):
+    print('%-32s %14s %12s %12s %9s' % ('benchmark', 'items/s', 'time (ms)', 'peak (MB)', 'change'))
+    for name, result in results.items():
+        change = ''
+        if baseline and name in baseline:
+            ratio = result['per_second'] / baseline[name]['per_second']
+            change = '%+.1f%%' % ((ratio - 1) * 100)
+        flag = '  REGRESSION' if name in regressions else ''
+        print('%-32s %14.0f %12.2f %12.2f %9s%s' % (name,
+                                                 result['per_second'],
+                                                 result['seconds'] * 1000,
+                                                 result['peak_bytes'] / 2**20,
+                                                 change, flag))
+
+def get_command_line_args():
+    parser = ArgumentParser(description='Run the rendering benchmarks')
+    parser.add_argument('-k', '--filter', type=str, help='only run the benchmarks matching this regular expression', default=None)
+    parser.add_argument('-r', '--repeat', type=int, help='timed calls per benchmark, the best is kept (default 3)', default=3)
+    parser.add_argument('--quick', action='store_true', help='small sizes only')
+    parser.add_argument('--save', type=str, help='save the results as a JSON baseline', default=None)
+    parser.add_argument('--compare', type=str, help='JSON baseline to compare against', default=None)
+    parser.add_argument('--tolerance', type=float, help='allowed slowdown before flagging a regression (default 0.15)', default=TOLERANCE)
+    return parser.parse_args()
+
+def main():
+    np.seterr(invalid='ignore')
+    args = get_command_line_args()
+
+    results = {}
+    for benchmark in benchmarks(args.quick):
+        if args.filter and not re.search(args.filter, benchmark.name):
+            continue
+        results[benchmark.name] = measure(benchmark, args.repeat)
+
+    baseline = None
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+
+    print_table(results, baseline, regressions)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'machine': platform.machine(),
+                       'results': results}, f, indent=2)
+
+    if regressions:
+        print('%d regression(s) against %s' % (len(regressions), args.compare))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
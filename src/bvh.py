@@ -0,0 +1,168 @@
+import numpy as np
+from vec3 import Vec3
+from hittable import Hittable, Sphere, SphereSet
+
+LEAF_SIZE = 4
+
+class BVH(Hittable):
+    '''Bounding volume hierarchy over a list of spheres.
+
+    The tree is built once and stored in flat arrays: the bounding boxes of
+    all nodes, the index of their children and, for leaves, the range of
+    spheres they hold (spheres are reordered so each leaf owns a contiguous
+    range).
+
+    Rays are traversed as a batch, one tree level at a time: every
+    (ray, node) pair whose box is hit is expanded into the node's children,
+    or intersected with the leaf's spheres. A ray therefore only tests the
+    spheres whose bounding boxes it intersects, and the number of NumPy
+    passes per bounce grows with the depth of the tree rather than with the
+    number of spheres.
+    '''
+    def __init__(self, spheres, leaf_size=LEAF_SIZE):
+        # spheres: Sphere hittables, or a SphereSet
+        if not isinstance(spheres, SphereSet):
+            spheres = list(spheres)
+            if not all(isinstance(x, Sphere) for x in spheres):
+                raise TypeError('BVH only supports Sphere hittables')
+            spheres = SphereSet(spheres)
+
+        self.leaf_size = leaf_size
+        self._build(spheres.center.interleaved(), spheres.radius)
+
+        # Spheres in leaf order, materials still in scene order
+        self.spheres = spheres.take(self._order)
+        # Boxes relative to the origin of the last camera, see _hit_boxes
+        self._origin_boxes = None
+
+    def _build(self, centers, radii):
+        box_min, box_max = [], []
+        left, right = [], []
+        start, count = [], []
+        order = []
+
+        lower = centers - radii[:, None]
+        upper = centers + radii[:, None]
+
+        def add_node(idx):
+            node = len(box_min)
+            box_min.append(lower[idx].min(axis=0))
+            box_max.append(upper[idx].max(axis=0))
+            left.append(-1)
+            right.append(-1)
+            start.append(len(order))
+            count.append(0)
+
+            if len(idx) <= self.leaf_size:
+                count[node] = len(idx)
+                order.extend(idx)
+                return node
+
+            # Median split along the longest axis of the centroid bounds
+            c = centers[idx]
+            axis = np.argmax(c.max(axis=0) - c.min(axis=0))
+            idx = idx[np.argsort(c[:, axis], kind='stable')]
+            half = len(idx) // 2
+            left[node] = add_node(idx[:half])
+            right[node] = add_node(idx[half:])
+            return node
+
+        if len(centers):
+            add_node(np.arange(len(centers)))
+
+        # Transposed copies so that each component is contiguous
+        box_min = np.array(box_min, dtype=np.float32).reshape(-1, 3).T.copy()
+        box_max = np.array(box_max, dtype=np.float32).reshape(-1, 3).T.copy()
+        self.box_min = Vec3(box_min[0], box_min[1], box_min[2])
+        self.box_max = Vec3(box_max[0], box_max[1], box_max[2])
+        self.left = np.array(left, dtype=np.int32)
+        self.right = np.array(right, dtype=np.int32)
+        self.start = np.array(start, dtype=np.int32)
+        self.count = np.array(count, dtype=np.int32)
+        self._order = np.array(order, dtype=np.int64)
+
+    def materials(self):
+        return self.spheres.materials()
+
+    def bind_materials(self, ids):
+        self.spheres.bind_materials(ids)
+
+    def _hit_boxes(self, origin, inv_direction, nodes, t_min, t_max):
+        # Slab test of each ray against the box of its paired node, with the
+        # boxes relative to the ray origins. Rays sharing a single origin
+        # (camera rays) use boxes moved once per frame.
+        if origin.x.ndim == 0:
+            key = (float(origin.x), float(origin.y), float(origin.z))
+            if self._origin_boxes is None or self._origin_boxes[0] != key:
+                self._origin_boxes = (key, self.box_min - origin, self.box_max - origin)
+            lo = self._origin_boxes[1][nodes]
+            hi = self._origin_boxes[2][nodes]
+        else:
+            lo = self.box_min[nodes] - origin
+            hi = self.box_max[nodes] - origin
+        t_near = np.full(len(nodes), t_min, dtype=np.float32)
+        t_far = t_max.copy()
+        for inv, l, h in ((inv_direction.x, lo.x, hi.x),
+                          (inv_direction.y, lo.y, hi.y),
+                          (inv_direction.z, lo.z, hi.z)):
+            t0 = l * inv
+            t1 = h * inv
+            # fmin/fmax ignore the NaN of 0*inf for rays parallel to a slab
+            t_near = np.fmax(t_near, np.fmin(t0, t1))
+            t_far = np.fmin(t_far, np.fmax(t0, t1))
+        return t_near <= t_far
+
+    def update_hit_record(self, rays, t_min, t_max, hit_record):
+        n = len(rays)
+        if n == 0 or len(self.count) == 0:
+            return
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_direction = Vec3.wrap(1.0 / rays.direction.x,
+                                      1.0 / rays.direction.y,
+                                      1.0 / rays.direction.z)
+
+        # Closest distance found so far for each ray, and the sphere it hit
+        closest_t = np.minimum(hit_record.t, t_max).astype(np.float32)
+        closest_sphere = np.full(n, -1, dtype=np.int64)
+
+        # Start with every ray paired with the root node
+        ray_ids = np.arange(n)
+        nodes = np.zeros(n, dtype=np.int32)
+
+        shared = rays.shared_origin
+        while len(ray_ids) > 0:
+            hit = self._hit_boxes(rays.origin if shared else rays.origin[ray_ids],
+                                  inv_direction[ray_ids],
+                                  nodes, t_min, closest_t[ray_ids])
+            ray_ids = ray_ids[hit]
+            nodes = nodes[hit]
+
+            is_leaf = self.count[nodes] > 0
+            leaf_rays = ray_ids[is_leaf]
+            leaf_nodes = nodes[is_leaf]
+
+            # Intersect the spheres of the leaves, k-th sphere of every leaf
+            # at a time
+            for k in range(self.leaf_size):
+                has_k = self.count[leaf_nodes] > k
+                r = leaf_rays[has_k]
+                if len(r) == 0:
+                    break
+                spheres = self.start[leaf_nodes[has_k]] + k
+                t = self.spheres.intersect(rays.origin if shared else rays.origin[r],
+                                           rays.direction[r],
+                                           spheres, t_min, closest_t[r])
+                # A ray can be paired with several leaves: keep the nearest
+                np.minimum.at(closest_t, r, t)
+                nearest = np.logical_and(t == closest_t[r], t != np.inf)
+                closest_sphere[r[nearest]] = spheres[nearest]
+
+            # Descend into the children of the inner nodes
+            inner = ~is_leaf
+            ray_ids = np.concatenate((ray_ids[inner], ray_ids[inner]))
+            nodes = np.concatenate((self.left[nodes[inner]], self.right[nodes[inner]]))
+
+        closest = np.where(closest_sphere >= 0)[0]
+        self.spheres.record_hits(rays, closest, closest_sphere[closest],
+                                 closest_t[closest], hit_record)
@@ -1,4 +1,5 @@
-from vec3 import Vec3, Point3
+import numpy as np
+from vec3 import Vec3, Point3, unit_vector, cross, scratch
 from ray import Ray
 
 class Camera:
@@ -6,27 +7,79 @@ class Camera:
                  aspect_ratio,
                  viewport_height,
                  focal_length,
-                 origin):
+                 origin,
+                 look_at=None,
+                 vup=Vec3(0, 1, 0)):
         aspect_ratio = aspect_ratio
         viewport_height = viewport_height
         viewport_width = aspect_ratio * viewport_height;
         focal_length = focal_length;
 
+        # Orthonormal basis of the camera: w points backwards, u to the
+        # right and v up. Without a look_at point the camera looks down -z.
+        if look_at is None:
+            w = Vec3(0, 0, 1)
+            u = Vec3(1, 0, 0)
+            v = Vec3(0, 1, 0)
+        else:
+            w = unit_vector(origin - look_at)
+            u = unit_vector(cross(vup, w))
+            v = cross(w, u)
+
         self.origin = origin
-        self.horizontal = Vec3(viewport_width, 0.0, 0.0);
-        self.vertical = Vec3(0.0, -viewport_height, 0.0);
+        self.horizontal = u * viewport_width;
+        self.vertical = v * -viewport_height;
         self.lower_left_corner = (self.origin
                                   - self.horizontal/2
                                   - self.vertical/2
-                                  - Vec3(0, 0, focal_length))
+                                  - w * focal_length)
+        # (width, height), directions and per pixel steps of the last
+        # frame, see ray_grid()
+        self._grid = None
+
+    def ray_grid(self, width, height):
+        '''Directions of the rays through the corner of every pixel of a
+        width x height frame, flattened row by row.
+
+        The grid is computed once per frame size and reused by every sample
+        pass: a jittered ray only adds its offset within the pixel to it,
+        see get_jittered_rays().
+        '''
+        if self._grid is None or self._grid[0] != (width, height):
+            i, j = np.divmod(np.arange(width * height), width)
+            step_u = self.horizontal / (width - 1)
+            step_v = self.vertical / (height - 1)
+            directions = (self.lower_left_corner - self.origin
+                          + step_u * j.astype(np.float32)
+                          + step_v * i.astype(np.float32))
+            self._grid = ((width, height), directions, step_u, step_v)
+        return self._grid[1]
+
+    def get_jittered_rays(self, base, du, dv):
+        '''Rays through the pixels whose ray_grid() directions are base,
+        offset by (du, dv) pixels.
+
+        All the rays share the camera origin, which is kept as a single
+        point rather than repeated for every ray. The directions are
+        written into a scratch buffer, valid until the next call.
+        '''
+        _, _, step_u, step_v = self._grid
+        direction = scratch.vec3('camera.direction', du.shape)
+        tmp = scratch.array('camera.tmp', du.shape)
+        for d, b, su, sv in ((direction.x, base.x, step_u.x, step_v.x),
+                             (direction.y, base.y, step_u.y, step_v.y),
+                             (direction.z, base.z, step_u.z, step_v.z)):
+            np.multiply(du, su, out=d)
+            d += b
+            d += np.multiply(dv, sv, out=tmp)
+        return Ray(self.origin, direction)
 
-    def get_ray(self, u, v):
-        all_origins = self.origin.tile((u.size,))
-        return Ray(all_origins, self.lower_left_corner
-                                + self.horizontal * u
-                                + self.vertical * v
-                                - all_origins)
+    def __getstate__(self):
+        # The grid is rebuilt where it is used rather than shipped along
+        state = dict(self.__dict__)
+        state['_grid'] = None
+        return state
 
-def get_camera(aspect_ratio, viewport_height, focal_length, origin):
-    return Camera(aspect_ratio, viewport_height, focal_length, origin)
+def get_camera(aspect_ratio, viewport_height, focal_length, origin, look_at=None, vup=Vec3(0, 1, 0)):
+    return Camera(aspect_ratio, viewport_height, focal_length, origin, look_at, vup)
 
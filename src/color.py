@@ -1,9 +1,11 @@
 import numpy as np
 from vec3 import Vec3, Point3, Color, unit_vector, dot, cross, length, length_squared
 from hittable import HitRecord, Sphere
+from material import material_table
 from helpers import random_in_unit_sphere, random_unit_vectors
 from ray import Ray
-from tqdm import tqdm
+import profiler
+import sampling
 
 img_centre = Point3(0, 0, -1)
 
@@ -117,8 +119,7 @@ def two_spheres_on_gradient(rays, world, settings):
     grad = gradient(rays, settings)
 
     hit_record = HitRecord(len(rays))
-    for hittable in world:
-        hittable.update_hit_record(rays, 0, np.inf, hit_record)
+    world.update_hit_record(rays, 0, np.inf, hit_record)
 
     hits = np.where(hit_record.t != np.inf)
     hit_color = (hit_record.normal[hits] + Vec3(1,1,1)) * 0.5
@@ -135,8 +136,7 @@ def color_depth(rays, world, settings):
 
         # Initialize all distances to infinite
         hit_record.t.fill(np.inf)
-        for hittable in world:
-            hittable.update_hit_record(rays, 0.001, np.inf, hit_record)
+        world.update_hit_record(rays, 0.001, np.inf, hit_record)
 
         # Rays that have hit something will be used in the next iteration
         hit_idx = np.where(hit_record.t != np.inf)[0]
@@ -166,50 +166,124 @@ def color_depth(rays, world, settings):
     
     return grad * frame_intensity
 
+def _sort_by_type(hit_record, table):
+    # Group the rays by material type with one stable sort: the order of
+    # the rays that hit each type, the size of each group and the rays that
+    # missed everything (last, in their own group)
+    n_types = len(table.types)
+    # Small integers: numpy sorts them with a radix sort
+    keys = table.type_of[hit_record.material_id]
+    keys[hit_record.t == np.inf] = n_types
+    order = np.argsort(keys, kind='stable')
+    counts = np.bincount(keys, minlength=n_types + 1)
+    return order, counts
+
+def _roulette(frame_intensity, index):
+    # Russian roulette: each path survives with a probability equal to its
+    # throughput (its largest channel, at most 1), and the survivors are
+    # reweighted by 1/probability so that the image stays unbiased. Dim
+    # paths, which add little to their pixel, are the likeliest to stop.
+    intensity = frame_intensity[index]
+    p = np.maximum(np.maximum(intensity.x, intensity.y), intensity.z)
+    np.minimum(p, 1.0, out=p)
+    survive = sampling.uniform(0.0, 1.0, len(index)) < p
+    p = p[survive]
+    frame_intensity[index[survive]] = intensity[survive] / p
+    return survive
+
+def scatter_hits(rays, hit_record, table, profile):
+    '''Scatter the rays that hit a material off it.
+
+    Returns the indices of the rays that missed everything, and for those
+    that hit, grouped by material type: their hit records, the scattered
+    directions, the attenuations and whether they scattered at all.
+    '''
+    # Sort the rays by material type once, so that each type scatters a
+    # contiguous segment (views, no copies) of the sorted rays
+    with profile.section('compaction'):
+        order, counts = _sort_by_type(hit_record, table)
+        n_hits = len(rays) - counts[-1]
+        missed = order[n_hits:]
+        hits = order[:n_hits]
+        sorted_rays = rays[hits]
+        sorted_rec = hit_record[hits]
+
+    next_direction = Vec3.empty(n_hits)
+    attenuation = Vec3.empty(n_hits)
+    is_scattered = np.empty(n_hits, dtype=np.bool_)
+
+    start = 0
+    for kind, params, count in zip(table.types, table.params, counts):
+        if count == 0:
+            continue
+        segment = slice(start, start + count)
+        start += count
+        profile.count_hits(kind.__name__, count)
+
+        with profile.section('scatter'):
+            rec = sorted_rec[segment]
+            result = kind.scatter_batch(sorted_rays[segment], rec, params,
+                                        table.slot[rec.material_id])
+
+        with profile.section('accumulate'):
+            next_direction[segment] = result.rays.direction
+            attenuation[segment] = result.attenuation
+            is_scattered[segment] = result.is_scattered
+    return missed, sorted_rec, next_direction, attenuation, is_scattered
+
 def color_materials(rays, world, settings):
+    profile = profiler.current()
     frame_intensity = Vec3.ones(len(rays))
     frame_rays = rays
     hit_record = HitRecord(len(rays))
 
-    materials = set([x.material for x in world])
+    # Material types come in scene order, so that the random streams
+    # consumed by scatter_batch() are reproducible
+    table = material_table(world)
 
     for d in range(settings.max_depth):
+        profile.start_depth(d, len(rays))
 
         # Initialize all distances to infinite and propagate all rays
         hit_record.t.fill(np.inf)
-        hit_record.material_id.fill(0)
-        for hittable in world:
-            hittable.update_hit_record(rays, 0.001, np.inf, hit_record)
-
-        for material in materials:
-            material_hits = np.where(hit_record.material_id == id(material))[0]
-            if len(material_hits) == 0:
-                continue
-
-            my_rays = rays[material_hits]
-            my_rec = hit_record[material_hits]
-            result = material.scatter(my_rays, my_rec)
-
-            # All rays have done something
-            rays[material_hits] = result.rays
-            frame_rays.direction[my_rec.index] = result.rays.direction
-
-            intensity = result.attenuation.multiply(frame_intensity[my_rec.index])
-            intensity[np.where(~result.is_scattered)] = Vec3(0,0,0)
-
-            frame_intensity[my_rec.index] = intensity
-
-            # Those that have been scattered stop here
-            not_scattered_material_idx = material_hits[~result.is_scattered]
-            hit_record.t[not_scattered_material_idx] = np.inf
+        with profile.section('update_hit_record'):
+            world.update_hit_record(rays, 0.001, np.inf, hit_record)
+        if not table.types:
+            break
 
-        # Iterate with those rays that have been scattered by something
-        scattered_rays = np.where(hit_record.t != np.inf)[0]
-        rays = rays[scattered_rays]
-        hit_record = hit_record[scattered_rays]
+        missed, sorted_rec, next_direction, attenuation, is_scattered = \
+            scatter_hits(rays, hit_record, table, profile)
+        with profile.section('compaction'):
+            # The rays that escape keep their direction for the sky gradient
+            frame_rays.direction[hit_record.index[missed]] = rays.direction[missed]
+
+        with profile.section('accumulate'):
+            frame_intensity[sorted_rec.index] = frame_intensity[sorted_rec.index].multiply(attenuation)
+
+        if settings.russian_roulette and d + 1 >= settings.roulette_depth:
+            with profile.section('roulette'):
+                is_scattered &= _roulette(frame_intensity, sorted_rec.index)
+
+        # Iterate with those rays that have been scattered by something: the
+        # rays of the next bounce start from the hit points
+        with profile.section('compaction'):
+            if is_scattered.all():
+                rays = Ray(sorted_rec.p, next_direction)
+                index = sorted_rec.index
+            else:
+                absorbed = sorted_rec.index[~is_scattered]
+                frame_intensity[absorbed] = Vec3(0, 0, 0)
+                rays = Ray(sorted_rec.p[is_scattered], next_direction[is_scattered])
+                index = sorted_rec.index[is_scattered]
+            hit_record = HitRecord(len(rays))
+            hit_record.index = index
+        profile.end_depth()
 
         if len(rays) == 0:
             break
+    else:
+        # Out of bounces: the last rays keep their direction too
+        frame_rays.direction[hit_record.index] = rays.direction
 
-    return gradient(frame_rays, settings).multiply(frame_intensity)
-
+    with profile.section('shade'):
+        return gradient(frame_rays, settings).multiply(frame_intensity)
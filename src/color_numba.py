@@ -0,0 +1,202 @@
+import warnings
+import weakref
+import numpy as np
+
+from vec3 import Vec3
+from hittable import HittableList, SphereSet
+from bvh import BVH
+from material import Lambertian, Metal
+from color import color_materials
+import sampling
+
+# Material type codes used by the kernel
+LAMBERTIAN = 0
+METAL = 1
+
+class FlatScene:
+    '''A world flattened into the plain arrays the compiled kernel reads'''
+    def __init__(self, world):
+        if isinstance(world, BVH):
+            spheres = world.spheres
+        elif isinstance(world, SphereSet):
+            spheres = world
+        elif isinstance(world, HittableList):
+            spheres = SphereSet(world.objects)
+        else:
+            raise TypeError('cannot flatten %s for the numba kernel' % type(world).__name__)
+
+        materials = spheres.materials()
+        self.center = np.ascontiguousarray(spheres.center.join(), dtype=np.float32)
+        self.radius = np.ascontiguousarray(spheres.radius, dtype=np.float32)
+        self.material_index = np.ascontiguousarray(spheres.material_index, dtype=np.int32)
+
+        self.material_type = np.empty(len(materials), dtype=np.int32)
+        self.albedo = np.empty((len(materials), 3), dtype=np.float32)
+        self.fuzz = np.zeros(len(materials), dtype=np.float32)
+        for i, material in enumerate(materials):
+            if isinstance(material, Lambertian):
+                self.material_type[i] = LAMBERTIAN
+            elif isinstance(material, Metal):
+                self.material_type[i] = METAL
+                self.fuzz[i] = material.fuzz
+            else:
+                raise TypeError('the numba kernel does not support %s' % type(material).__name__)
+            a = material.albedo
+            self.albedo[i] = (a.x, a.y, a.z)
+
+# Flattening is done once per world, not once per sample pass
+_flat_scenes = weakref.WeakKeyDictionary()
+
+def _flatten(world):
+    scene = _flat_scenes.get(world)
+    if scene is None:
+        scene = FlatScene(world)
+        _flat_scenes[world] = scene
+    return scene
+
+# The compiled kernel. numba is slow to import, so it is only imported
+# (and the kernel compiled) by the first render that uses color_numba.
+_kernel = None
+
+def _compile():
+    global _kernel
+    if _kernel is not None:
+        return _kernel
+    try:
+        import numba
+    except ImportError:
+        _kernel = False
+        return _kernel
+
+    _GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+    _MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+    _MIX2 = np.uint64(0x94D049BB133111EB)
+
+    @numba.njit(inline='always')
+    def _next_uniform(state):
+        # splitmix64: a counter based generator, so every ray owns its own
+        # stream and the result does not depend on thread scheduling
+        state = state + _GOLDEN
+        z = state
+        z = (z ^ (z >> np.uint64(30))) * _MIX1
+        z = (z ^ (z >> np.uint64(27))) * _MIX2
+        z = z ^ (z >> np.uint64(31))
+        return np.float32(z >> np.uint64(40)) * np.float32(1.0 / 16777216.0), state
+
+    @numba.njit(parallel=True)
+    def _trace(origin, direction, seed,
+               center, radius, material_index,
+               material_type, albedo, fuzz,
+               max_depth, out):
+        n = origin.shape[1]
+        n_spheres = radius.size
+        for i in numba.prange(n):
+            state = np.uint64(seed) + np.uint64(i) * _MIX2
+            ox, oy, oz = origin[0, i], origin[1, i], origin[2, i]
+            dx, dy, dz = direction[0, i], direction[1, i], direction[2, i]
+            ar, ag, ab = np.float32(1.0), np.float32(1.0), np.float32(1.0)
+
+            for depth in range(max_depth):
+                # Nearest sphere hit
+                a = dx*dx + dy*dy + dz*dz
+                closest_t = np.float32(np.inf)
+                closest = -1
+                for s in range(n_spheres):
+                    ocx = ox - center[0, s]
+                    ocy = oy - center[1, s]
+                    ocz = oz - center[2, s]
+                    half_b = ocx*dx + ocy*dy + ocz*dz
+                    c = ocx*ocx + ocy*ocy + ocz*ocz - radius[s]*radius[s]
+                    discriminant = half_b*half_b - a*c
+                    if discriminant < 0:
+                        continue
+                    root = np.sqrt(discriminant)
+                    t = (-half_b - root) / a
+                    if not (0.001 < t < closest_t):
+                        t = (-half_b + root) / a
+                        if not (0.001 < t < closest_t):
+                            continue
+                    closest_t = t
+                    closest = s
+
+                if closest < 0:
+                    break
+
+                px = ox + closest_t*dx
+                py = oy + closest_t*dy
+                pz = oz + closest_t*dz
+                nx = (px - center[0, closest]) / radius[closest]
+                ny = (py - center[1, closest]) / radius[closest]
+                nz = (pz - center[2, closest]) / radius[closest]
+                if dx*nx + dy*ny + dz*nz >= 0:
+                    nx, ny, nz = -nx, -ny, -nz
+
+                m = material_index[closest]
+                if material_type[m] == LAMBERTIAN:
+                    # normal + random unit vector
+                    u, state = _next_uniform(state)
+                    w, state = _next_uniform(state)
+                    z = 2*u - 1
+                    r = np.sqrt(max(np.float32(0), 1 - z*z))
+                    phi = np.float32(2*np.pi) * w
+                    dx, dy, dz = nx + r*np.cos(phi), ny + r*np.sin(phi), nz + z
+                else:
+                    # fuzzy reflection of the unit direction
+                    length = np.sqrt(a)
+                    ux, uy, uz = dx/length, dy/length, dz/length
+                    k = 2*(ux*nx + uy*ny + uz*nz)
+                    dx, dy, dz = ux - k*nx, uy - k*ny, uz - k*nz
+                    f = fuzz[m]
+                    if f > 0:
+                        while True:
+                            u, state = _next_uniform(state)
+                            v, state = _next_uniform(state)
+                            w, state = _next_uniform(state)
+                            rx, ry, rz = 2*u - 1, 2*v - 1, 2*w - 1
+                            if rx*rx + ry*ry + rz*rz < 1:
+                                break
+                        dx, dy, dz = dx + f*rx, dy + f*ry, dz + f*rz
+                    if dx*nx + dy*ny + dz*nz <= 0:
+                        ar, ag, ab = np.float32(0), np.float32(0), np.float32(0)
+                        break
+
+                ar *= albedo[m, 0]
+                ag *= albedo[m, 1]
+                ab *= albedo[m, 2]
+                ox, oy, oz = px, py, pz
+
+            # Escaped (or out of bounces): sky gradient, as color.gradient
+            length = np.sqrt(dx*dx + dy*dy + dz*dz)
+            t = np.float32(0.5) * (dy/length + 1)
+            out[0, i] = ar * ((1 - t) + t*np.float32(0.5))
+            out[1, i] = ag * ((1 - t) + t*np.float32(0.7))
+            out[2, i] = ab * ((1 - t) + t*np.float32(1.0))
+
+    _kernel = _trace
+    return _kernel
+
+def color_numba(rays, world, settings):
+    '''color_materials, with the whole bounce loop compiled by numba.
+
+    Each ray runs its own loop over depth and spheres without building any
+    temporary arrays. Falls back to color_materials when numba is not
+    installed.
+    '''
+    trace = _compile()
+    if not trace:
+        warnings.warn('numba is not installed, falling back to color_materials')
+        return color_materials(rays, world, settings)
+
+    scene = _flatten(world)
+    # Camera rays share a single origin, the kernel wants one per ray
+    origin = np.ascontiguousarray(np.broadcast_to(rays.origin.join(), (3, len(rays))), dtype=np.float32)
+    direction = np.ascontiguousarray(rays.direction.join(), dtype=np.float32)
+    # Seeded from the render's random stream, so seeded renders reproduce
+    seed = sampling.generator().integers(0, 2**63 - 1, dtype=np.int64)
+
+    out = np.empty((3, len(rays)), dtype=np.float32)
+    trace(origin, direction, seed,
+          scene.center, scene.radius, scene.material_index,
+          scene.material_type, scene.albedo, scene.fuzz,
+          settings.max_depth, out)
+    return Vec3.wrap(out[0], out[1], out[2])
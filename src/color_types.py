@@ -2,6 +2,7 @@ from enum import Enum
 from color import gradient,                        red_sphere_blue_gradient, \
                   sphere_normal_map_blue_gradient, two_spheres_on_gradient,  \
                   color_depth,                     color_materials
+from color_numba import color_numba
 
 class RayColor(object):
     def __init__(self, function):
@@ -14,4 +15,5 @@ class Colors(Enum):
     two_spheres_on_gradient = RayColor(two_spheres_on_gradient)
     color_depth = RayColor(color_depth)
     color_materials = RayColor(color_materials)
+    color_numba = RayColor(color_numba)
 
@@ -2,14 +2,50 @@ from argparse import ArgumentParser
 from settings import Settings
 from color_types import Colors
 from scenes import Scenes
+from scene_loader import load_scene
+from accelerators import ACCELERATORS
+from sampling import BIT_GENERATORS, JITTERS
+from vec3 import LAYOUTS, get_layout
+from renderer import ENGINES
 
 def get_command_line_args():
     parser = ArgumentParser()
     parser.add_argument('-s', '--scene', type=str, choices=[s.name for s in Scenes], help='scene name (default world3)', default='world3')
+    parser.add_argument('--scene-file', type=str, help='render the scene of this JSON or TOML file instead (see scene_loader)', default=None)
+    parser.add_argument('--no-scene-cache', action='store_true', help='compile the scene file again instead of using its cached compiled world')
     parser.add_argument('-w', '--width', type=int, help='image width (default 400)', default=400)
     parser.add_argument('-a', '--aspect', dest='aspect_ratio', type=float, help='image aspect ratio (default=16/9)', default=16.0/9.0)
     parser.add_argument('-p', '--samples', dest='samples_per_pixel', type=int, help='samples per pixel (default 10)', default=10)
     parser.add_argument('-d', '--max-depth', type=int, help='max depth (default 50)', default=50)
+    parser.add_argument('--russian-roulette', action='store_true', help='randomly stop dim paths after --roulette-depth bounces, without bias')
+    parser.add_argument('--roulette-depth', type=int, help='bounces before Russian roulette starts (default 3)', default=3)
+    parser.add_argument('-t', '--tile-size', type=int, help='rays traced per tile, 0 for the whole frame (default: the fewest equal tiles of at most 262144 rays)', default=None)
+    parser.add_argument('--workers', type=int, help='number of render processes (default 1)', default=1)
+    parser.add_argument('--engine', type=str, choices=ENGINES, help='passes: trace sample passes tile by tile, wavefront: keep a fixed size pool of paths full (default passes)', default='passes')
+    parser.add_argument('--wavefront-size', type=int, help='paths in flight in the wavefront engine (default 65536)', default=65536)
+    parser.add_argument('--listen', type=str, help='host:port the distributed engine serves workers on (default 127.0.0.1:8766), see distributed', default='127.0.0.1:8766')
+    parser.add_argument('--local-workers', type=int, help='worker processes the distributed engine starts on this machine (default 0)', default=0)
+    parser.add_argument('--unit-samples', type=int, help='samples per work unit of the distributed engine, 0 for whole tiles (default 8)', default=8)
+    parser.add_argument('--unit-timeout', type=float, help='seconds before the unit of a silent worker is handed out again (default off)', default=None)
+    parser.add_argument('--seed', type=int, help='random seed, for reproducible renders (default random)', default=None)
+    parser.add_argument('--rng', type=str, choices=list(BIT_GENERATORS), help='random bit generator (default pcg64)', default='pcg64')
+    parser.add_argument('--jitter', type=str, choices=list(JITTERS), help='sub-pixel jitter pattern of the camera rays (default random)', default='random')
+    parser.add_argument('--accelerator', type=str, choices=list(ACCELERATORS), help='scene acceleration structure (default auto)', default='auto')
+    parser.add_argument('--vec3-layout', type=str, choices=LAYOUTS, help='vector memory layout (default planar)', default=get_layout())
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not show a progress bar')
+    parser.add_argument('--profile', action='store_true', help='record per-bounce statistics to images/profile.json')
+    parser.add_argument('-o', '--output', type=str, help='stream the image to this file as it renders: .ppm, .npy (linear float32) or any PIL format (default images/img.bmp at the end)', default=None)
+    parser.add_argument('--accumulator-file', type=str, help='memory-map the sample accumulator to this .npy file, for frames larger than memory', default=None)
+    parser.add_argument('--checkpoint', type=str, help='save the state of the render to this .npz file when it ends', default=None)
+    parser.add_argument('--checkpoint-every', type=int, help='also save the checkpoint every N sample passes (default off)', default=0)
+    parser.add_argument('--resume', type=str, help='continue the render saved in this checkpoint', default=None)
+    parser.add_argument('--noise-threshold', type=float, help='stop once the noise of every pixel is below this (default off)', default=None)
+    parser.add_argument('--min-samples', type=int, help='samples per pixel before checking the noise (default 8)', default=8)
+    parser.add_argument('--adaptive', action='store_true', help='after --min-samples passes, only trace the pixels above the noise threshold (default 0.02)')
+    parser.add_argument('--time-budget', type=float, help='stop rendering after this many seconds (default off)', default=None)
+    parser.add_argument('--preview-every', type=int, help='save a preview image every N sample passes (default off)', default=0)
+    parser.add_argument('--denoise', action='store_true', help='filter the noise out of the final image, guided by the normals, albedos and depths of the first hits (--output then only receives the denoised image, at the end)')
+    parser.add_argument('--denoise-iterations', type=int, help='denoiser passes, each twice as wide as the previous one (default 5)', default=5)
     parser.add_argument('-f', '--shader', dest='shader_function',
                                           type=str,
                                           choices=[s.name for s  in Colors],
@@ -21,9 +57,47 @@ def parse_args():
     args = vars(get_command_line_args())
 
     arguments = {}
+    # a scene file brings its own camera settings
+    camera = {}
+    if args["scene_file"]:
+        scene_file = load_scene(args["scene_file"], args["accelerator"], cache=not args["no_scene_cache"])
+        arguments["scene"] = scene_file.world
+        camera = scene_file.settings
+    else:
+        arguments["scene"] = Scenes[args["scene"]].value.build()
+
     # render settings
-    arguments["settings"] = Settings(args["aspect_ratio"], args["width"], args["samples_per_pixel"], args["max_depth"])
-    arguments["scene"] = Scenes[args["scene"]].value
+    arguments["settings"] = Settings(args["aspect_ratio"], args["width"], args["samples_per_pixel"], args["max_depth"],
+                                     russian_roulette=args["russian_roulette"],
+                                     roulette_depth=args["roulette_depth"],
+                                     tile_size=args["tile_size"],
+                                     workers=args["workers"],
+                                     engine=args["engine"],
+                                     wavefront_size=args["wavefront_size"],
+                                     listen=args["listen"],
+                                     local_workers=args["local_workers"],
+                                     unit_samples=args["unit_samples"],
+                                     unit_timeout=args["unit_timeout"],
+                                     seed=args["seed"],
+                                     rng=args["rng"],
+                                     jitter=args["jitter"],
+                                     accelerator=args["accelerator"],
+                                     vec3_layout=args["vec3_layout"],
+                                     progress=not args["quiet"],
+                                     profile=args["profile"],
+                                     output=args["output"],
+                                     accumulator_file=args["accumulator_file"],
+                                     checkpoint=args["checkpoint"],
+                                     checkpoint_every=args["checkpoint_every"],
+                                     resume=args["resume"],
+                                     noise_threshold=args["noise_threshold"],
+                                     min_samples=args["min_samples"],
+                                     time_budget=args["time_budget"],
+                                     preview_every=args["preview_every"],
+                                     adaptive=args["adaptive"],
+                                     denoise=args["denoise"],
+                                     denoise_iterations=args["denoise_iterations"],
+                                     **camera)
     arguments["shader_function"] = Colors[args["shader_function"]].value.function
 
     return arguments
@@ -0,0 +1,149 @@
+'''Edge-avoiding à-trous wavelet denoiser.
+
+A render with few samples per pixel is mostly right on average but noisy
+from pixel to pixel. The denoiser averages each pixel with its neighbours,
+over wider and wider footprints: every iteration applies the 5x5 B3-spline
+kernel with its taps 2^i pixels apart, so 5 iterations cover 125x125 pixels
+for 25 taps per pixel each. Neighbours only count when they look like the
+same surface, judged from auxiliary buffers of the first hit of camera rays
+(normal, albedo and distance), and from the color itself relative to the
+pixel's noise:
+
+    w = h(dx) h(dy) exp(-|l_p - l_q| / (SIGMA_COLOR sqrt(var_p))
+                        -|n_p - n_q|^2 / SIGMA_NORMAL^2
+                        -|a_p - a_q|^2 / SIGMA_ALBEDO^2
+                        -|z_p - z_q| / (SIGMA_DEPTH z_p 2^i))
+
+var_p is the variance of the pixel's mean luminance, estimated from its
+samples and carried through the iterations: as the image gets smoother,
+the color differences allowed get smaller.
+
+The colors are divided by the albedo before filtering and multiplied back
+after (only the lighting is blurred, not the surfaces' colors). See
+Dammertz et al., Edge-Avoiding À-Trous Wavelet Transform for fast Global
+Illumination Filtering, HPG 2010, and Schied et al., Spatiotemporal
+Variance-Guided Filtering, HPG 2017, for the variance estimate.
+'''
+from collections import namedtuple
+
+import numpy as np
+
+import sampling
+from hittable import HitRecord
+from material import material_table
+
+ITERATIONS = 5
+# Jittered camera rays per pixel traced for the auxiliary buffers
+AUX_SAMPLES = 4
+# Random stream of the auxiliary rays, a key no work unit uses
+AUX_KEY = (0, 0, 0)
+# Distance recorded for the rays that hit nothing
+MISS_DEPTH = 1e4
+
+SIGMA_COLOR = 4.0
+SIGMA_NORMAL = 0.5
+SIGMA_ALBEDO = 0.1
+SIGMA_DEPTH = 0.1
+
+_KERNEL = np.array([1/16, 1/4, 3/8, 1/4, 1/16], dtype=np.float32)
+_BLUR = np.array([1/4, 1/2, 1/4], dtype=np.float32)
+_LUMINANCE = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+# Per pixel averages of the first hit of camera rays: normal and albedo
+# (N, 3), distance (N)
+Aux = namedtuple('Aux', 'normal albedo depth')
+
+def aux_buffers(renderer, world, samples=AUX_SAMPLES):
+    '''The auxiliary buffers of the frame rendered by renderer, from
+    samples jittered camera rays per pixel that only go as far as their
+    first hit'''
+    settings = renderer.settings
+    n_pixels = settings.width * settings.height
+    table = material_table(world)
+    normal = np.zeros((n_pixels, 3), dtype=np.float32)
+    albedo = np.zeros((n_pixels, 3), dtype=np.float32)
+    depth = np.zeros(n_pixels, dtype=np.float32)
+
+    sampling.seed(renderer._entropy, *AUX_KEY, rng=settings.rng)
+    for start, stop in renderer._tiles():
+        pixels = np.arange(start, stop)
+        for sample in range(samples):
+            rays = renderer._camera_rays(pixels, sample)
+            hit_record = HitRecord(len(rays))
+            world.update_hit_record(rays, 0.001, np.inf, hit_record)
+            hit = hit_record.t != np.inf
+
+            normal[start:stop] += np.where(hit[:, None], hit_record.normal.interleaved(), 0)
+            if table.materials:
+                hit_albedo = table.albedo[hit_record.material_id].interleaved()
+            else:
+                hit_albedo = np.ones((len(rays), 3), dtype=np.float32)
+            albedo[start:stop] += np.where(hit[:, None], hit_albedo, 1)
+            depth[start:stop] += np.where(hit, hit_record.t, MISS_DEPTH)
+    normal /= samples
+    albedo /= samples
+    depth /= samples
+    return Aux(normal, albedo, depth)
+
+def denoise(color, variance, aux, width, height, iterations=ITERATIONS):
+    '''The denoised linear colors (N, 3) of a frame.
+
+    color: the noisy linear colors (N, 3), variance: the variance of the
+    mean luminance of each pixel (N, inf where unknown), aux: the Aux of
+    the frame.
+    '''
+    shape = (height, width)
+    albedo = np.maximum(aux.albedo, 1e-3).reshape(shape + (3,))
+    normal = aux.normal.reshape(shape + (3,))
+    depth = aux.depth.reshape(shape)
+    # Only the lighting is filtered, and its variance along with it
+    result = (color.reshape(shape + (3,)) / albedo).astype(np.float32)
+    variance = variance.reshape(shape).astype(np.float32) / np.square(albedo @ _LUMINANCE)
+    # Unknown at one sample: as noisy as the noisiest known pixel
+    known = np.isfinite(variance)
+    variance[~known] = variance[known].max() if known.any() else 1.0
+
+    for i in range(iterations):
+        step = 2**i
+        pad = 2 * step
+
+        def shifted(image, step=step, pad=pad):
+            # The taps of the iteration: views of the image padded by
+            # repeating its borders
+            padded = np.pad(image, ((pad, pad), (pad, pad)) + ((0, 0),) * (image.ndim - 2), mode='edge')
+            return lambda dy, dx: padded[pad + dy*step:pad + dy*step + height,
+                                         pad + dx*step:pad + dx*step + width]
+
+        luminance = result @ _LUMINANCE
+        # The variance estimates of few samples are noisy themselves: they
+        # are blurred a little before use
+        blurred = shifted(variance, 1, 1)
+        smooth_variance = sum(_BLUR[dy + 1] * _BLUR[dx + 1] * blurred(dy, dx)
+                              for dy in range(-1, 2) for dx in range(-1, 2))
+        color_scale = 1.0 / (SIGMA_COLOR * np.sqrt(smooth_variance) + 1e-4)
+        depth_scale = 1.0 / (SIGMA_DEPTH * depth * step + 1e-4)
+
+        taps = [shifted(x) for x in (result, variance, luminance, normal, albedo, depth)]
+        total = np.zeros_like(result)
+        total_variance = np.zeros(shape, dtype=np.float32)
+        weights = np.zeros(shape, dtype=np.float32)
+        for dy in range(-2, 3):
+            for dx in range(-2, 3):
+                q_color, q_variance, q_luminance, q_normal, q_albedo, q_depth = (tap(dy, dx) for tap in taps)
+                exponent = np.abs(luminance - q_luminance) * color_scale
+                exponent += np.square(normal - q_normal).sum(axis=-1) / SIGMA_NORMAL**2
+                exponent += np.square(albedo - q_albedo).sum(axis=-1) / SIGMA_ALBEDO**2
+                exponent += np.abs(depth - q_depth) * depth_scale
+                w = np.exp(-exponent)
+                w *= _KERNEL[dy + 2] * _KERNEL[dx + 2]
+                total += w[..., None] * q_color
+                total_variance += np.square(w) * q_variance
+                weights += w
+        result = total / weights[..., None]
+        variance = total_variance / np.square(weights)
+
+    return (result * albedo).reshape(-1, 3)
+
+def luminance_variance(accumulator):
+    '''Variance of the mean luminance of each pixel of accumulator'''
+    return np.square(accumulator.std_error()).T @ np.square(_LUMINANCE.astype(np.float64))
@@ -0,0 +1,322 @@
+'''Render a frame on several machines.
+
+The coordinator is an ordinary render (main.py) with the distributed
+engine: it splits the frame into work units, one per tile and range of
+settings.unit_samples samples, and serves them over TCP to the workers
+that connect to it. Each worker renders the units it pulls and sends back
+their accumulation statistics (float arrays, see Accumulator), which the
+coordinator adds into the frame's accumulator. Everything downstream,
+the writer, checkpoints and Renderer.save, runs in the coordinator as
+for a local render.
+
+    export RAYTRACE_AUTHKEY=...                         (on every host)
+    python main.py --engine distributed --listen 0.0.0.0:8766 -w 3840 -p 1024
+    python distributed.py coordinator-host:8766         (on every worker host)
+
+The units of a worker whose connection drops go back to the queue, and
+so, with --unit-timeout, do the units a worker has held for too long (a
+hung or unreachable host): the first result to come back is used. With
+--local-workers N the coordinator also starts N worker processes of its
+own, which is enough to try it all out on a single machine.
+
+Both ends prove they hold the same secret key, the RAYTRACE_AUTHKEY
+environment variable, before anything else is exchanged, and neither
+starts without one. A coordinator with only local workers makes up a
+random key of its own. The coordinator sends the renderer, scene and
+shader to the workers pickled, as the process pool does, so workers must
+only connect to a coordinator they trust; the coordinator never unpickles
+what workers send.
+'''
+import os
+import sys
+import hmac
+import time
+import queue
+import pickle
+import socket
+import struct
+import threading
+import socketserver
+import multiprocessing
+from argparse import ArgumentParser
+from collections import deque
+
+import numpy as np
+
+from accumulator import Accumulator, Engine, UnitAccumulator, split_units, unit_size
+from vec3 import set_layout
+
+# Environment variable holding the secret key shared by the coordinator
+# and its workers
+AUTHKEY_VARIABLE = 'RAYTRACE_AUTHKEY'
+# Seconds a worker keeps trying to reach a coordinator that is not up yet
+RETRY = 30.0
+
+_LENGTH = struct.Struct('!Q')
+# Size of the messages of the handshake
+_CHALLENGE_SIZE = 32
+
+def _send(sock, data):
+    sock.sendall(_LENGTH.pack(len(data)))
+    sock.sendall(data)
+
+def _recv_exactly(sock, n):
+    data = bytearray(n)
+    view = memoryview(data)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError('connection closed')
+        view = view[received:]
+    return data
+
+def _recv(sock, limit=None):
+    # A message from _send(), as a bytearray
+    length, = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    if limit is not None and length > limit:
+        raise ConnectionError('message of %d bytes, expected at most %d' % (length, limit))
+    return _recv_exactly(sock, length)
+
+def _authenticate(sock, authkey, role, peer):
+    # Each end sends a random challenge and answers the other's with the
+    # HMAC of its role and the challenge: the role keeps a peer from
+    # passing our own challenge back to us
+    challenge = os.urandom(_CHALLENGE_SIZE)
+    _send(sock, challenge)
+    other = _recv(sock, _CHALLENGE_SIZE)
+    _send(sock, hmac.new(authkey, role + other, 'sha256').digest())
+    expected = hmac.new(authkey, peer + challenge, 'sha256').digest()
+    if not hmac.compare_digest(bytes(_recv(sock, len(expected))), expected):
+        raise ConnectionError('authentication failed, check RAYTRACE_AUTHKEY')
+
+def get_authkey():
+    '''The shared secret key of RAYTRACE_AUTHKEY, None when unset'''
+    key = os.environ.get(AUTHKEY_VARIABLE)
+    return key.encode() if key else None
+
+def parse_address(address):
+    '''(host, port) of a 'host:port' string'''
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def run_worker(address, authkey, retry=RETRY):
+    '''Render the units of the coordinator at address (host, port) until it
+    has none left, returns the number of units rendered'''
+    np.seterr(invalid='ignore')
+    deadline = time.monotonic() + retry
+    while True:
+        try:
+            sock = socket.create_connection(address)
+            break
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.5)
+
+    rendered = 0
+    with sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _authenticate(sock, authkey, b'worker', b'coordinator')
+        renderer, scene, ray_color = pickle.loads(_recv(sock))
+        set_layout(renderer.settings.vec3_layout)
+        while True:
+            unit = pickle.loads(_recv(sock))
+            if unit is None:
+                return rendered
+            n = unit_size(unit.pixels)
+            buffer = bytearray(Accumulator.nbytes(n))
+            try:
+                renderer._render_unit(scene, ray_color, unit, UnitAccumulator(n, buffer=buffer))
+            except Exception as e:
+                # The coordinator fails the render with it
+                _send(sock, ('%s: %s' % (type(e).__name__, e)).encode())
+                raise
+            _send(sock, b'')
+            _send(sock, buffer)
+            rendered += 1
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    # Serves units to one worker connection, in its own thread
+    def handle(self):
+        engine = self.server.engine
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        unit = None
+        try:
+            _authenticate(sock, engine.authkey, b'coordinator', b'worker')
+            _send(sock, engine.job)
+            while True:
+                unit = engine.next_unit()
+                _send(sock, pickle.dumps(unit, protocol=pickle.HIGHEST_PROTOCOL))
+                if unit is None:
+                    return
+                error = _recv(sock, 1 << 16)
+                if error:
+                    engine.results.put((unit, RuntimeError('worker %s:%d failed: %s'
+                                                           % (self.client_address + (error.decode(),)))))
+                    unit = None
+                    return
+                nbytes = Accumulator.nbytes(unit_size(unit.pixels))
+                data = _recv(sock, nbytes)
+                if len(data) != nbytes:
+                    raise ConnectionError('%d bytes of statistics, expected %d' % (len(data), nbytes))
+                engine.results.put((unit, data))
+                unit = None
+        except OSError as e:
+            if engine.settings.progress:
+                print('worker %s:%d lost: %s' % (self.client_address + (e,)), file=sys.stderr, flush=True)
+        finally:
+            if unit is not None:
+                engine.requeue(unit)
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class DistributedEngine(Engine):
+    '''Render work units on workers connected over TCP, see the module
+    documentation.
+
+    The units are split in ranges of settings.unit_samples samples. The
+    random streams are keyed by tile and sample, so the image is that of
+    the passes engine up to the rounding of the sums. The units split
+    from a tile share its pixels: their results are added in this process,
+    one at a time.
+    '''
+    def __init__(self, renderer, scene, ray_color):
+        settings = renderer.settings
+        self.authkey = get_authkey()
+        if self.authkey is None:
+            if not settings.local_workers:
+                raise ValueError('set %s to a secret key shared with the workers' % AUTHKEY_VARIABLE)
+            # Only the worker processes started here can know it
+            self.authkey = os.urandom(32)
+        super().__init__(settings)
+        self.settings = settings
+        self.job = pickle.dumps((renderer, scene, ray_color), protocol=pickle.HIGHEST_PROTOCOL)
+        # (unit, statistics or exception) of the units rendered
+        self.results = queue.Queue()
+        self._pending = deque()
+        # Keys of the units in _pending
+        self._pending_keys = set()
+        # Keys of the units of the current run() not rendered yet
+        self._remaining = set()
+        # Units handed out and not rendered yet, by key, with the time they
+        # were last handed out
+        self._outstanding = {}
+        self._closed = False
+        self._lock = threading.Condition()
+
+        self._server = _Server(parse_address(settings.listen), _Handler)
+        self._server.engine = self
+        self.address = self._server.server_address[:2]
+        # Forked before the server thread starts
+        self._processes = [multiprocessing.Process(target=run_worker, args=(self.address, self.authkey))
+                           for _ in range(settings.local_workers)]
+        for process in self._processes:
+            process.start()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        if settings.progress:
+            print('coordinator listening on %s:%d' % self.address, file=sys.stderr, flush=True)
+
+    def next_unit(self):
+        '''The next unit to render, waits for one. None once the engine is
+        closed.'''
+        with self._lock:
+            while True:
+                while not self._pending and not self._closed:
+                    self._lock.wait()
+                if self._closed:
+                    return None
+                unit = self._pending.popleft()
+                self._pending_keys.discard(unit.key)
+                # A unit requeued and rendered since is not handed out again
+                if unit.key in self._remaining:
+                    self._outstanding[unit.key] = (unit, time.monotonic())
+                    return unit
+
+    def requeue(self, unit):
+        '''Hand the unit out again, unless it has been rendered since or
+        is waiting already'''
+        with self._lock:
+            if unit.key in self._outstanding and unit.key not in self._pending_keys:
+                self._pending.appendleft(unit)
+                self._pending_keys.add(unit.key)
+                self._outstanding[unit.key] = (unit, time.monotonic())
+                self._lock.notify()
+
+    def run(self, units, on_unit=None):
+        '''Render the units and wait for them, on_unit(unit) is called in
+        this process as each completes'''
+        units = split_units(units, self.settings.unit_samples)
+        remaining = {unit.key for unit in units}
+        with self._lock:
+            self._remaining = set(remaining)
+            self._pending.extend(units)
+            self._pending_keys.update(remaining)
+            self._lock.notify_all()
+
+        timeout = self.settings.unit_timeout
+        while remaining:
+            try:
+                unit, data = self.results.get(timeout=timeout / 4 if timeout else None)
+            except queue.Empty:
+                self._requeue_late(timeout)
+                continue
+            if isinstance(data, Exception):
+                raise data
+            with self._lock:
+                self._outstanding.pop(unit.key, None)
+                self._remaining.discard(unit.key)
+            if unit.key not in remaining:
+                # A late duplicate of a unit that was handed out again
+                continue
+            remaining.discard(unit.key)
+            self.accumulator.merge(Accumulator(unit_size(unit.pixels), buffer=data), unit.pixels)
+            if on_unit:
+                on_unit(unit)
+            if timeout:
+                self._requeue_late(timeout)
+
+    def _requeue_late(self, timeout):
+        # Units held for longer than timeout go to another worker as well
+        now = time.monotonic()
+        with self._lock:
+            late = [unit for unit, started in self._outstanding.values() if now - started > timeout]
+        for unit in late:
+            self.requeue(unit)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._pending.clear()
+            self._pending_keys.clear()
+            self._lock.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        super().close()
+
+
+def get_command_line_args():
+    parser = ArgumentParser(description='Render work units for a coordinator (main.py --engine distributed)')
+    parser.add_argument('address', type=str, help='host:port of the coordinator')
+    parser.add_argument('--retry', type=float, help='seconds to keep trying to connect (default 30)', default=RETRY)
+    args = parser.parse_args()
+    if get_authkey() is None:
+        parser.error('set %s to the secret key of the coordinator' % AUTHKEY_VARIABLE)
+    return args
+
+def main():
+    args = get_command_line_args()
+    rendered = run_worker(parse_address(args.address), get_authkey(), retry=args.retry)
+    print('%d units rendered' % rendered)
+
+if __name__ == '__main__':
+    main()
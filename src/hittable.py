@@ -1,7 +1,7 @@
 import numpy as np
 from collections import namedtuple
 from abc import abstractmethod
-from vec3 import Vec3, Point3, Color, unit_vector, dot, cross, length, length_squared
+from vec3 import Vec3, Point3, Color, unit_vector, dot, cross, length, length_squared, scratch
 from ray import Ray
 
 class HitRecord:
@@ -11,10 +11,10 @@ class HitRecord:
         self.t           = empty or np.full(n, np.inf, dtype=np.float32)
         self.front_face  = empty or np.zeros(n, dtype=np.float32)
         self.index       = empty or np.arange(n, dtype=np.int32)
-        self.material_id = empty or np.zeros(n, dtype=np.int64)
+        self.material_id = empty or np.zeros(n, dtype=np.int32)
 
     def __getitem__(self, idx):
-        other = HitRecord(len(idx), empty=True)
+        other = HitRecord(0, empty=True)
         other.p          = self.p[idx]
         other.normal     = self.normal[idx]
         other.t          = self.t[idx]
@@ -27,34 +27,98 @@ class Hittable:
     @abstractmethod
     def update_hit_record(rays, t_min, t_max, hit_record: HitRecord):
         pass
-    
+
+    def materials(self):
+        '''Materials used by this hittable, in scene order'''
+        return []
+
+    def bind_materials(self, ids):
+        '''Record the given material ids (keyed by id() of the materials,
+        see MaterialTable) for the hits from now on'''
+        pass
+
+class HittableList(Hittable):
+    # Plain list of hittables, each one tested against every ray
+    def __init__(self, objects):
+        self.objects = list(objects)
+
+    def update_hit_record(self, rays, t_min, t_max, hit_record):
+        for hittable in self.objects:
+            hittable.update_hit_record(rays, t_min, t_max, hit_record)
+
+    def materials(self):
+        return list(dict.fromkeys(m for x in self.objects for m in x.materials()))
+
+    def bind_materials(self, ids):
+        for hittable in self.objects:
+            hittable.bind_materials(ids)
+
+def nearest_root(oc, direction, radius, t_min, t_max, c=None):
+    '''Nearest t in (t_min, t_max) where |oc + t*direction| = radius.
+
+    oc is the ray origin relative to the sphere center. All arguments
+    broadcast together; the result is inf where there is no hit. Every
+    intermediate lives in the scratch workspace, and so does the result,
+    which is only valid until the next call. c = |oc|^2 - radius^2 can be
+    given when it is already known, see SphereSet.origin_constants().
+    '''
+    # Need to calculate the roots of equation:
+    # t^2 d.d + 2t d.oc + oc.oc - r^2 = 0
+    # with half_b = d.oc, the roots are (-half_b +/- sqrt(half_b^2 - ac))/a
+    shape = np.broadcast_shapes(oc.x.shape, direction.x.shape)
+    a = length_squared(direction, out=scratch.array('sphere.a', direction.x.shape))
+    half_b = dot(oc, direction, out=scratch.array('sphere.half_b', shape))
+    if c is None:
+        c = length_squared(oc, out=scratch.array('sphere.c', oc.x.shape))
+        c -= np.multiply(radius, radius, dtype=np.float32)
+
+    discriminant = np.multiply(half_b, half_b, out=scratch.array('sphere.discriminant', shape))
+    # a*c goes to the buffer of t1, which is not needed yet
+    discriminant -= np.multiply(a, c, out=scratch.array('sphere.t1', shape))
+    root = np.sqrt(discriminant, out=discriminant)
+
+    # calculate both roots of the quadratic
+    t1 = np.negative(half_b, out=scratch.array('sphere.t1', shape))
+    t1 -= root
+    t1 /= a
+    t2 = np.subtract(root, half_b, out=half_b)
+    t2 /= a
+
+    # Keep the roots between the min/max values for t, precedence to t1
+    # (closest)
+    t = scratch.array('sphere.t', shape)
+    t.fill(np.inf)
+    hit = scratch.array('sphere.hit', shape, dtype=np.bool_)
+    in_range = scratch.array('sphere.in_range', shape, dtype=np.bool_)
+    for candidate in (t2, t1):
+        np.less(candidate, t_max, out=hit)
+        hit &= np.greater(candidate, t_min, out=in_range)
+        np.copyto(t, candidate, where=hit)
+    return t
+
 class Sphere(Hittable):
     def __init__(self, center, radius, material):
         self.center = center
         self.radius = radius
         self.material = material
+        self.material_id = 0
+
+    def materials(self):
+        return [self.material]
+
+    def bind_materials(self, ids):
+        self.material_id = ids[id(self.material)]
 
     def update_hit_record(self, rays, t_min, t_max, hit_record):
-        oc = rays.origin - self.center
-        a = length_squared(rays.direction)
-        half_b = dot(oc, rays.direction)
-        c = length_squared(oc) - self.radius*self.radius
-        discriminant = half_b*half_b - a*c
-
-        root = np.sqrt(discriminant)
-        # calculate both roots of the quadratic
-        t1 = (-half_b - root) / a
-        t2 = (-half_b + root) / a
-        # Check whether the roots are between the min/max values for t
-        hit1 = np.logical_and(t1 < t_max, t1 > t_min)
-        hit2 = np.logical_and(t2 < t_max, t2 > t_min)
-
-        # Combine the two hits, precedence to t1 (closest)
-        t = np.where(hit2, t2, np.inf)
-        t = np.where(hit1, t1, t)
+        if rays.shared_origin:
+            # A single oc for all the rays
+            oc = rays.origin - self.center
+        else:
+            oc = rays.origin.subtract(self.center, out=scratch.vec3('sphere.oc', len(rays)))
+        t = nearest_root(oc, rays.direction, self.radius, t_min, t_max)
 
         # Detect where in the rays list we are the closest hit
-        closest = np.where(t < hit_record.t)
+        closest = np.flatnonzero(t < hit_record.t)
         
         # Calculate normal
         hit_rays = rays[closest]
@@ -69,4 +133,141 @@ class Sphere(Hittable):
         hit_record.normal[closest] = normal
         hit_record.t[closest] = t[closest]
         hit_record.front_face[closest] = front_face
-        hit_record.material_id[closest] = id(self.material)
+        hit_record.material_id[closest] = self.material_id
+
+
+class SphereSet(Hittable):
+    '''Many spheres stored as contiguous arrays of centers, radii and
+    material indices.
+
+    The nearest hit of a ray batch is found in a single vectorized
+    (rays x spheres) pass instead of one pass per sphere. Rays are processed
+    in chunks so the pairwise arrays stay below CHUNK_SIZE elements.
+    '''
+    CHUNK_SIZE = 2**20
+
+    def __init__(self, spheres, materials=None):
+        spheres = list(spheres)
+        if not all(isinstance(x, Sphere) for x in spheres):
+            raise TypeError('SphereSet only supports Sphere hittables')
+
+        if materials is None:
+            materials = dict.fromkeys(x.material for x in spheres)
+        self._materials = list(materials)
+        index = {id(m): i for i, m in enumerate(self._materials)}
+
+        self.center = Vec3(np.array([x.center.x for x in spheres], dtype=np.float32),
+                           np.array([x.center.y for x in spheres], dtype=np.float32),
+                           np.array([x.center.z for x in spheres], dtype=np.float32))
+        self.radius = np.array([x.radius for x in spheres], dtype=np.float32)
+        self.material_index = np.array([index[id(x.material)] for x in spheres],
+                                       dtype=np.int32)
+        # Material id of each of the materials, by default their index:
+        # the ids of a world made of this set alone
+        self.material_ids = np.arange(len(self._materials), dtype=np.int32)
+        self._origin_constants = None
+
+    @classmethod
+    def from_arrays(cls, center, radius, material_index, materials):
+        '''A set built straight from its arrays: center (N, 3), radius (N),
+        material_index (N) indexing the materials list'''
+        spheres = cls.__new__(cls)
+        center = np.asarray(center, dtype=np.float32).reshape(-1, 3)
+        spheres.center = Vec3(center[:, 0].copy(), center[:, 1].copy(), center[:, 2].copy())
+        spheres.radius = np.ascontiguousarray(radius, dtype=np.float32)
+        spheres.material_index = np.ascontiguousarray(material_index, dtype=np.int32)
+        spheres._materials = list(materials)
+        spheres.material_ids = np.arange(len(spheres._materials), dtype=np.int32)
+        spheres._origin_constants = None
+        return spheres
+
+    def take(self, indices):
+        '''The spheres at indices, in that order, with the same materials'''
+        return SphereSet.from_arrays(self.center[indices].interleaved(), self.radius[indices],
+                                     self.material_index[indices], self._materials)
+
+    def spheres(self):
+        '''The set as a list of Sphere hittables'''
+        return [Sphere(Point3(*c), float(r), self._materials[m])
+                for c, r, m in zip(self.center.interleaved(), self.radius, self.material_index)]
+
+    def __len__(self):
+        return self.radius.size
+
+    def materials(self):
+        return list(self._materials)
+
+    def bind_materials(self, ids):
+        self.material_ids = np.array([ids[id(m)] for m in self._materials], dtype=np.int32)
+
+    def origin_constants(self, origin):
+        '''oc and c (see nearest_root) of every sphere for rays starting at
+        the single point origin.
+
+        They do not depend on the ray directions: for camera rays they are
+        computed once per frame instead of once per ray and sphere.
+        '''
+        key = (float(origin.x), float(origin.y), float(origin.z))
+        if self._origin_constants is None or self._origin_constants[0] != key:
+            oc = Vec3.wrap(origin.x - self.center.x, origin.y - self.center.y, origin.z - self.center.z)
+            c = length_squared(oc) - self.radius * self.radius
+            self._origin_constants = (key, oc, c)
+        return self._origin_constants[1:]
+
+    def intersect(self, origin, direction, spheres, t_min, t_max):
+        '''Nearest root of each ray against the sphere paired with it.
+
+        origin, direction, spheres and t_max must all have the same shape
+        (or broadcast together), or origin is a single point shared by all
+        the rays. Returns inf where there is no hit, in a scratch buffer.
+        '''
+        if origin.x.ndim == 0:
+            oc, c = self.origin_constants(origin)
+            return nearest_root(oc[spheres], direction, self.radius[spheres], t_min, t_max,
+                                c=c[spheres])
+        center = self.center[spheres]
+        shape = np.broadcast_shapes(origin.x.shape, center.x.shape)
+        oc = origin.subtract(center, out=scratch.vec3('sphereset.oc', shape))
+        return nearest_root(oc, direction, self.radius[spheres], t_min, t_max)
+
+    def record_hits(self, rays, closest, spheres, t, hit_record):
+        '''Write the hits of rays[closest] on the given spheres, at distance t'''
+        hit_rays = rays[closest]
+
+        p = hit_rays.at(t)
+        outward_normal = (p - self.center[spheres]) / self.radius[spheres]
+        front_face = dot(hit_rays.direction, outward_normal) < 0
+        normal = Vec3.where(front_face, outward_normal, -outward_normal)
+
+        hit_record.p[closest] = p
+        hit_record.normal[closest] = normal
+        hit_record.t[closest] = t
+        hit_record.front_face[closest] = front_face
+        hit_record.material_id[closest] = self.material_ids[self.material_index[spheres]]
+
+    def update_hit_record(self, rays, t_min, t_max, hit_record):
+        n_spheres = len(self)
+        if n_spheres == 0:
+            return
+
+        chunk = max(1, self.CHUNK_SIZE // n_spheres)
+        for start in range(0, len(rays), chunk):
+            stop = min(start + chunk, len(rays))
+            # Rays along the first axis, spheres along the second
+            if rays.shared_origin:
+                origin = rays.origin
+            else:
+                origin = Vec3.wrap(rays.origin.x[start:stop, None],
+                                   rays.origin.y[start:stop, None],
+                                   rays.origin.z[start:stop, None])
+            direction = Vec3.wrap(rays.direction.x[start:stop, None],
+                                  rays.direction.y[start:stop, None],
+                                  rays.direction.z[start:stop, None])
+            closest_t = np.minimum(hit_record.t[start:stop], t_max)
+
+            t = self.intersect(origin, direction, slice(None), t_min, closest_t[:, None])
+            nearest = np.argmin(t, axis=1)
+            t = t[np.arange(stop - start), nearest]
+
+            closest = np.where(t < closest_t)[0]
+            self.record_hits(rays, start + closest, nearest[closest], t[closest], hit_record)
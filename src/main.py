@@ -1,3 +1,4 @@
+import os
 import numpy as np
 from command_line_args import parse_args
 from renderer import Renderer
@@ -6,9 +7,12 @@ from renderer import Renderer
 def render(settings, scene, shader_function, display=True, save=True):
     renderer = Renderer(settings)
     renderer.render(scene, shader_function)
-    if save:
+    if save and renderer.image is not None:
         renderer.save()
-    if display:
+    if renderer.profile:
+        renderer.profile.save(os.path.join('images', 'profile.json'))
+        print(renderer.profile.summary())
+    if display and renderer.image is not None:
         renderer.display()
 
 def main():
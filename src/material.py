@@ -1,6 +1,7 @@
+import weakref
 from collections import namedtuple
 import numpy as np
-from vec3 import Vec3, Point3, Color, unit_vector, dot, cross, length, length_squared
+from vec3 import Vec3, Point3, Color, unit_vector, dot, cross, length, length_squared, scratch
 from ray import Ray
 from hittable import HitRecord
 from helpers import random_unit_vectors, random_in_unit_sphere
@@ -8,9 +9,50 @@ from helpers import random_unit_vectors, random_in_unit_sphere
 ScatterResult = namedtuple('ScatterResult', 'attenuation rays is_scattered')
 
 class Material:
-    def scatter(r_in: Ray, ray_idx, rec: HitRecord) -> ScatterResult:
+    def scatter(self, r_in: Ray, rec: HitRecord) -> ScatterResult:
+        '''The scattered rays and masks may live in scratch buffers reused by
+        the next call to scatter(), callers copy out what they keep'''
         pass
 
+    @classmethod
+    def pack(cls, materials):
+        '''Parameters of the given instances of this type, indexed by their
+        position in the list, see MaterialTable.
+
+        Without a batched implementation, the parameters are the instances
+        themselves.
+        '''
+        return list(materials)
+
+    @classmethod
+    def scatter_batch(cls, r_in: Ray, rec: HitRecord, params, slots) -> ScatterResult:
+        '''Scatter rays that hit any instance of this type: slots holds the
+        index in params (see pack) of the instance each ray hit.
+
+        This default makes one scatter() call per instance; the built-in
+        types gather their per ray parameters instead and make one call
+        for all their instances.
+        '''
+        n = len(r_in)
+        attenuation = Vec3.empty(n)
+        direction = Vec3.empty(n)
+        is_scattered = np.empty(n, dtype=np.bool_)
+        for slot in np.unique(slots):
+            rays = np.flatnonzero(slots == slot)
+            result = params[slot].scatter(r_in[rays], rec[rays])
+            attenuation[rays] = result.attenuation
+            direction[rays] = result.rays.direction
+            is_scattered[rays] = result.is_scattered
+        return ScatterResult(attenuation, Ray(rec.p, direction), is_scattered)
+
+def _stack(colors):
+    # One Vec3 of arrays out of a list of single colors
+    return Vec3(np.array([c.x for c in colors], dtype=np.float32),
+                np.array([c.y for c in colors], dtype=np.float32),
+                np.array([c.z for c in colors], dtype=np.float32))
+
+LambertianParams = namedtuple('LambertianParams', 'albedo')
+
 class Lambertian(Material):
     # scatters rays and attenuates by the albedo
     def __init__(self, albedo: Color):
@@ -18,16 +60,43 @@ class Lambertian(Material):
         self.albedo = albedo
 
     def scatter(self, r_in: Ray, rec: HitRecord) -> ScatterResult:
+        return self._scatter(r_in, rec, self.albedo)
+
+    @classmethod
+    def pack(cls, materials):
+        return LambertianParams(albedo=_stack([m.albedo for m in materials]))
+
+    @classmethod
+    def scatter_batch(cls, r_in: Ray, rec: HitRecord, params, slots) -> ScatterResult:
+        return cls._scatter(r_in, rec, params.albedo[slots])
 
-        scatter_direction = rec.normal + random_unit_vectors(len(r_in))
+    @staticmethod
+    def _scatter(r_in, rec, albedo):
+        # albedo: a single color, or one per ray
+        scatter_direction = random_unit_vectors(len(r_in))
+        scatter_direction += rec.normal
         scattered = Ray(rec.p, scatter_direction)
 
-        return ScatterResult(attenuation = self.albedo,
+        is_scattered = scratch.array('lambertian.is_scattered', len(r_in), dtype=np.bool_)
+        is_scattered.fill(True)
+
+        return ScatterResult(attenuation = albedo,
                              rays = scattered,
-                             is_scattered = np.full(len(r_in), True, dtype=np.bool))
+                             is_scattered = is_scattered)
+
+def reflect(v, n, out=None):
+    if out is None:
+        return v - n*2*dot(v, n)
+    # out may be v itself
+    k = dot(v, n, out=scratch.array('reflect.k', v.x.shape))
+    k *= 2
+    tmp = scratch.array('reflect.tmp', v.x.shape)
+    np.subtract(v.x, np.multiply(n.x, k, out=tmp), out=out.x)
+    np.subtract(v.y, np.multiply(n.y, k, out=tmp), out=out.y)
+    np.subtract(v.z, np.multiply(n.z, k, out=tmp), out=out.z)
+    return out
 
-def reflect(v, n):
-    return v - n*2*dot(v, n)
+MetalParams = namedtuple('MetalParams', 'albedo fuzz')
 
 class Metal(Material):
 
@@ -36,11 +105,81 @@ class Metal(Material):
         self.fuzz = f if f < 1 else 1
 
     def scatter(self, r_in: Ray, rec: HitRecord) -> ScatterResult:
+        return self._scatter(r_in, rec, self.albedo, self.fuzz)
 
-        reflected = reflect(unit_vector(r_in.direction), rec.normal)
-        scatter_direction = reflected + random_in_unit_sphere(len(r_in))*self.fuzz
-        scattered = Ray(rec.p, scatter_direction);
+    @classmethod
+    def pack(cls, materials):
+        return MetalParams(albedo=_stack([m.albedo for m in materials]),
+                           fuzz=np.array([m.fuzz for m in materials], dtype=np.float32))
 
-        return ScatterResult(attenuation = self.albedo,
+    @classmethod
+    def scatter_batch(cls, r_in: Ray, rec: HitRecord, params, slots) -> ScatterResult:
+        return cls._scatter(r_in, rec, params.albedo[slots], params.fuzz[slots])
+
+    @staticmethod
+    def _scatter(r_in, rec, albedo, fuzz):
+        # albedo and fuzz: single values, or one per ray
+        n = len(r_in)
+        scatter_direction = unit_vector(r_in.direction, out=scratch.vec3('metal.direction', n))
+        reflect(scatter_direction, rec.normal, out=scatter_direction)
+        fuzz_direction = random_in_unit_sphere(n)
+        fuzz_direction *= fuzz
+        scatter_direction += fuzz_direction
+        scattered = Ray(rec.p, scatter_direction)
+
+        cos_theta = dot(scattered.direction, rec.normal, out=scratch.array('metal.cos_theta', n))
+        is_scattered = np.greater(cos_theta, 0, out=scratch.array('metal.is_scattered', n, dtype=np.bool_))
+
+        return ScatterResult(attenuation = albedo,
                              rays = scattered,
-                             is_scattered = dot(scattered.direction, rec.normal) > 0)
+                             is_scattered = is_scattered)
+
+
+class MaterialTable:
+    '''The materials of a world compiled for batched scattering.
+
+    Every material gets a small integer id, its position in the world's
+    materials(), which the hittables record for their hits (see
+    Hittable.bind_materials). The instances of each material type are
+    packed into parameter arrays, so that all the rays that hit a type are
+    scattered by one scatter_batch() call: the dispatch cost of a bounce
+    depends on the number of material types, not of instances.
+
+    types: the material types, in order of first appearance
+    params: the packed parameters of each type
+    type_of, slot: type index and index in the type's parameters of each
+    material id
+    albedo: the albedo of each material id (white for the materials without
+    one), for the denoiser
+    '''
+    def __init__(self, materials):
+        self.materials = list(materials)
+        self.types = list(dict.fromkeys(type(m) for m in self.materials))
+        type_index = {t: i for i, t in enumerate(self.types)}
+        instances = [[] for _ in self.types]
+        self.type_of = np.empty(len(self.materials), dtype=np.int16)
+        self.slot = np.empty(len(self.materials), dtype=np.int32)
+        for i, m in enumerate(self.materials):
+            k = type_index[type(m)]
+            self.type_of[i] = k
+            self.slot[i] = len(instances[k])
+            instances[k].append(m)
+        self.params = [t.pack(m) for t, m in zip(self.types, instances)]
+        self.albedo = _stack([getattr(m, 'albedo', Color(1, 1, 1)) for m in self.materials])
+
+    def ids(self):
+        '''Material id of each material, keyed by id()'''
+        return {id(m): i for i, m in enumerate(self.materials)}
+
+# Tables of the worlds rendered by this process
+_tables = weakref.WeakKeyDictionary()
+
+def material_table(world):
+    '''The MaterialTable of world, compiled and bound to its hittables on
+    first use'''
+    table = _tables.get(world)
+    if table is None:
+        table = MaterialTable(world.materials())
+        world.bind_materials(table.ids())
+        _tables[world] = table
+    return table
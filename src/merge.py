@@ -0,0 +1,53 @@
+'''Merge the checkpoints of independent renders of the same frame.
+
+The sample budget of a frame can be split across runs (or machines) with
+different seeds, each saving its result with --checkpoint. Adding their
+accumulators gives the image of all their samples together:
+
+    python main.py --seed 1 -p 100 --checkpoint a.npz
+    python main.py --seed 2 -p 100 --checkpoint b.npz
+    python merge.py a.npz b.npz -o merged.png --checkpoint merged.npz
+'''
+from argparse import ArgumentParser
+
+from accumulator import Accumulator
+from writers import get_writer
+
+def merge(paths):
+    '''The sum of the accumulators saved in paths, with the metadata of
+    the merged checkpoint'''
+    merged, metadata = Accumulator.load(paths[0])
+    for path in paths[1:]:
+        accumulator, other = Accumulator.load(path)
+        if (other['width'], other['height']) != (metadata['width'], metadata['height']):
+            raise ValueError('%s is a %dx%d render, %s is %dx%d' % (path, other['width'], other['height'],
+                             paths[0], metadata['width'], metadata['height']))
+        merged.merge(accumulator)
+        metadata['passes'] += other['passes']
+    # The streams of the merged runs overlap: resuming it must not reuse them
+    metadata['entropy'] = None
+    return merged, metadata
+
+def get_command_line_args():
+    parser = ArgumentParser(description='Add up the samples of several checkpoints of a frame')
+    parser.add_argument('checkpoints', type=str, nargs='+', help='.npz checkpoints to merge')
+    parser.add_argument('-o', '--output', type=str, help='image to write, see writers (default merged.png)', default='merged.png')
+    parser.add_argument('--checkpoint', type=str, help='also save the merged accumulator as a checkpoint', default=None)
+    return parser.parse_args()
+
+def main():
+    args = get_command_line_args()
+    merged, metadata = merge(args.checkpoints)
+
+    writer = get_writer(args.output)
+    writer.open(metadata['width'], metadata['height'])
+    writer.write(merged, slice(None))
+    writer.close(merged)
+
+    if args.checkpoint:
+        merged.save(args.checkpoint, **metadata)
+    print('%d checkpoints, %d samples per pixel on average: %s' % (len(args.checkpoints),
+          round(merged.samples() / merged.n_pixels), args.output))
+
+if __name__ == '__main__':
+    main()
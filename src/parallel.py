@@ -0,0 +1,118 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+from accumulator import Accumulator, Engine, UnitAccumulator, split_units, unit_size
+from vec3 import set_layout
+import profiler
+
+# Per-process state of a render worker, set up once by _init_worker
+_worker = {}
+
+def _init_worker(renderer, scene, ray_color, shm_name, n_pixels):
+    np.seterr(invalid='ignore')
+    set_layout(renderer.settings.vec3_layout)
+    _worker['renderer'] = renderer
+    _worker['scene'] = scene
+    _worker['ray_color'] = ray_color
+    if renderer.settings.accumulator_file:
+        _worker['accumulator'] = Accumulator.open(renderer.settings.accumulator_file, n_pixels)
+    else:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker['shm'] = shm
+        _worker['accumulator'] = Accumulator(n_pixels, buffer=shm.buf)
+    if renderer.settings.profile:
+        profiler.enable()
+
+def _render_unit(unit, shared=True):
+    # The units of a round never share pixels, so workers accumulate
+    # straight into the shared buffers without any locking. Units split
+    # from a tile do, and are sent back to be added by the parent process.
+    data = None
+    if shared:
+        accumulator = _worker['accumulator']
+    else:
+        data = bytearray(Accumulator.nbytes(unit_size(unit.pixels)))
+        accumulator = UnitAccumulator(unit_size(unit.pixels), buffer=data)
+    _worker['renderer']._render_unit(_worker['scene'], _worker['ray_color'], unit, accumulator)
+    # Hand the statistics of the unit over to the parent process
+    profile = profiler.current()
+    if profile.enabled:
+        profiler.enable()
+        return data, profile.to_dict()
+    return data, None
+
+class ProcessPoolEngine(Engine):
+    '''Render work units on a pool of worker processes.
+
+    Each worker receives the renderer, scene and shader once, when the pool
+    starts, and accumulates its samples into an Accumulator held in shared
+    memory instead of sending tiles back through pickled arrays. Once the
+    engine is closed, accumulator is a private copy of the result.
+
+    With settings.accumulator_file, the accumulator is the memory-mapped
+    file instead, which all the processes map and which stays the result.
+
+    A round of fewer units than workers is split by samples to keep them
+    all busy, see split_units(). The random streams are keyed by tile and
+    sample, so the image is the same up to the rounding of the sums, which
+    the parent process then adds one unit at a time.
+    '''
+    def __init__(self, renderer, scene, ray_color):
+        settings = renderer.settings
+        n_pixels = settings.width * settings.height
+
+        self._shm = None
+        if not settings.accumulator_file:
+            self._shm = shared_memory.SharedMemory(create=True, size=Accumulator.nbytes(n_pixels))
+        super().__init__(settings, self._shm and self._shm.buf)
+        self._workers = settings.workers
+        self._pool = ProcessPoolExecutor(max_workers=settings.workers,
+                                         initializer=_init_worker,
+                                         initargs=(renderer, scene, ray_color,
+                                                   self._shm and self._shm.name, n_pixels))
+
+    def run(self, units, on_unit=None):
+        '''Render the units, which must not overlap, and wait for them.
+
+        on_unit(unit) is called in this process as each unit completes.
+        '''
+        shared = True
+        if units and len(units) < self._workers:
+            n_samples = max(unit.n_samples for unit in units)
+            parts = -(-self._workers // len(units))
+            split = split_units(units, -(-n_samples // parts))
+            shared = len(split) == len(units)
+            units = split
+        futures = {self._pool.submit(_render_unit, unit, shared): unit for unit in units}
+        profile = profiler.current()
+        try:
+            for future in as_completed(futures):
+                data, statistics = future.result()
+                if statistics:
+                    profile.merge(statistics)
+                unit = futures[future]
+                if data is not None:
+                    self.accumulator.merge(Accumulator(unit_size(unit.pixels), buffer=data), unit.pixels)
+                if on_unit:
+                    on_unit(unit)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def close(self):
+        self._pool.shutdown()
+        if self._shm is None:
+            super().close()
+            return
+        # Copy out of the shared block before it is released
+        shared = self.accumulator
+        self.accumulator = shared.copy()
+        del shared
+        try:
+            self._shm.close()
+        except BufferError:
+            # Someone still holds a view: the mapping goes away with it
+            pass
+        self._shm.unlink()
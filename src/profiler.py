@@ -0,0 +1,133 @@
+'''Opt-in instrumentation of the render hot path.
+
+The shaders report what they do through the profiler returned by
+current(): the rays alive at each bounce depth, how many of them hit each
+material, and the time spent in named sections (intersection, scattering,
+random sampling, compaction...). A section's time excludes that of the
+sections nested in it, e.g. the random sampling of scattering, so that
+the sections add up to the time profiled. Profiling is disabled by default, and
+current() then returns a NullProfiler whose methods do nothing, so the
+instrumented code pays one method call per section and per bounce.
+'''
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+_NO_SECTION = nullcontext()
+
+class NullProfiler:
+    '''Stands in for a Profiler when profiling is disabled'''
+    enabled = False
+
+    def start_depth(self, depth, rays):
+        pass
+
+    def end_depth(self):
+        pass
+
+    def count_hits(self, material, hits):
+        pass
+
+    def section(self, name):
+        return _NO_SECTION
+
+class Profiler:
+    '''Statistics of a render, per bounce depth.
+
+    Sections timed outside of any bounce (e.g. camera ray generation) are
+    recorded under the 'frame' entry.
+    '''
+    enabled = True
+
+    def __init__(self):
+        self.depths = defaultdict(self._new_entry)
+        self.frame = self._new_entry()
+        self._depth = None
+        # Time spent in the sections nested in each open section
+        self._nested = []
+
+    @staticmethod
+    def _new_entry():
+        return {'rays': 0, 'hits': defaultdict(int), 'seconds': defaultdict(float)}
+
+    def _entry(self):
+        return self.frame if self._depth is None else self.depths[self._depth]
+
+    def start_depth(self, depth, rays):
+        self._depth = depth
+        self.depths[depth]['rays'] += rays
+
+    def end_depth(self):
+        self._depth = None
+
+    def count_hits(self, material, hits):
+        self._entry()['hits'][material] += int(hits)
+
+    @contextmanager
+    def section(self, name):
+        entry = self._entry()
+        self._nested.append(0.0)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - t0
+            entry['seconds'][name] += seconds - self._nested.pop()
+            if self._nested:
+                self._nested[-1] += seconds
+
+    def to_dict(self):
+        def entry(e):
+            return {'rays': e['rays'], 'hits': dict(e['hits']), 'seconds': dict(e['seconds'])}
+        return {
+            'frame': entry(self.frame),
+            'depths': [dict(depth=d, **entry(self.depths[d])) for d in sorted(self.depths)],
+        }
+
+    def merge(self, data):
+        '''Add the statistics of another profiler, as returned by to_dict()'''
+        for source in [dict(data['frame'], depth=None)] + data['depths']:
+            target = self.frame if source['depth'] is None else self.depths[source['depth']]
+            target['rays'] += source['rays']
+            for material, hits in source['hits'].items():
+                target['hits'][material] += hits
+            for name, seconds in source['seconds'].items():
+                target['seconds'][name] += seconds
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self):
+        '''Table of the statistics, one row per depth, with the time of
+        each section exclusive of the sections nested in it'''
+        data = self.to_dict()
+        sections = sorted({name for d in data['depths'] for name in d['seconds']})
+        materials = sorted({m for d in data['depths'] for m in d['hits']})
+
+        lines = ['%5s %10s' % ('depth', 'rays')
+                 + ''.join(' %12s' % m for m in materials)
+                 + ''.join(' %18s' % ('%s (ms)' % s) for s in sections)]
+        for d in data['depths']:
+            lines.append('%5d %10d' % (d['depth'], d['rays'])
+                         + ''.join(' %12d' % d['hits'].get(m, 0) for m in materials)
+                         + ''.join(' %18.2f' % (d['seconds'].get(s, 0.0) * 1000) for s in sections))
+        for name, seconds in sorted(data['frame']['seconds'].items()):
+            lines.append('frame %s: %.2f ms' % (name, seconds * 1000))
+        return '\n'.join(lines)
+
+_current = NullProfiler()
+
+def current():
+    '''The active profiler, a NullProfiler when profiling is disabled'''
+    return _current
+
+def enable():
+    global _current
+    _current = Profiler()
+    return _current
+
+def disable():
+    global _current
+    _current = NullProfiler()
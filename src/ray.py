@@ -1,4 +1,6 @@
 class Ray:
+    '''A batch of rays: origin holds one point per ray, or a single point shared
+    by all of them (camera rays), see shared_origin'''
     def __init__(self, origin, direction):
         self.origin = origin
         self.direction = direction
@@ -6,14 +8,19 @@ class Ray:
     def at(self, t):
         return self.origin + self.direction*t
     
+    @property
+    def shared_origin(self):
+        return self.origin.x.ndim == 0
+
     def __getitem__(self, idx):
-        return Ray(self.origin[idx], self.direction[idx])
+        origin = self.origin if self.shared_origin else self.origin[idx]
+        return Ray(origin, self.direction[idx])
 
     def __setitem__(self, idx, other):
         self.origin[idx] = other.origin
         self.direction[idx] = other.direction
     
     def __len__(self):
-        return self.origin.x.size
+        return self.direction.x.size
 
 
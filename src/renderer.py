@@ -1,34 +1,133 @@
 import os
+import time
 import numpy as np
-from PIL import Image
-import matplotlib.pyplot as plt
-from tqdm import tqdm
 
-from settings import Settings
+from settings import Settings, DEFAULT_CHECKPOINT, MAX_TILE_SIZE
 from camera import Camera
-from helpers import random_uniform
-from vec3 import Vec3
+import sampling
+from parallel import ProcessPoolEngine
+from accumulator import Accumulator, Engine, WorkUnit
+from vec3 import Vec3, set_layout
+from accelerators import build_world
+from writers import get_writer
+import profiler
+
+# Ways of tracing the work units: 'passes' traces each unit sample pass by
+# sample pass (on a pool of processes with several workers), 'wavefront'
+# streams the samples through a pool of paths, see wavefront, and
+# 'distributed' hands the units out to workers on other machines, see
+# distributed
+ENGINES = ('passes', 'wavefront', 'distributed')
+
+
+class _NoProgress:
+    # Stands in for the progress bar of a quiet render
+    def __init__(self, initial):
+        self.n = initial
+
+    def update(self, n):
+        self.n += n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def _progress_bar(total, initial, enabled):
+    # tqdm is only imported by the renders that show it
+    if not enabled:
+        return _NoProgress(initial)
+    from tqdm import tqdm
+    return tqdm(total=total, initial=initial)
+
+
+class SerialEngine(Engine):
+    '''Render work units one after the other in the current process'''
+    def __init__(self, renderer, scene, ray_color):
+        super().__init__(renderer.settings)
+        self._render_unit = lambda unit: renderer._render_unit(scene, ray_color, unit, self.accumulator)
+
+    def run(self, units, on_unit=None):
+        for unit in units:
+            self._render_unit(unit)
+            if on_unit:
+                on_unit(unit)
 
 
 class Renderer(object):
-    def __init__(self, settings=None):
+    def __init__(self, settings=None, on_progress=None, writer=None):
         self.settings = settings if settings else Settings()
-        self.camera = Camera(settings.aspect_ratio,
-                             settings.viewport_height,
-                             settings.focal_length,
-                             settings.camera_origin)
+        set_layout(self.settings.vec3_layout)
+        self.camera = Camera(self.settings.aspect_ratio,
+                             self.settings.viewport_height,
+                             self.settings.focal_length,
+                             self.settings.camera_origin,
+                             self.settings.camera_look_at,
+                             self.settings.camera_vup)
+        # Called as on_progress(accumulator, passes) after every round of
+        # sample passes
+        self.on_progress = on_progress
+        # Where the image goes as it is rendered (see writers), by default
+        # the writer of settings.output. Without one, render() returns the
+        # image as a PIL image. A denoised render writes its final image
+        # only, once denoised.
+        if writer is None and self.settings.output:
+            writer = get_writer(self.settings.output)
+        self.writer = writer
+        self.accumulator = None
+        # profiler.Profiler of the last render, when settings.profile is set
+        self.profile = None
         self.image = None
 
     def render(self, scene, ray_color, apply_gamma=True):
-        colors = self._compute_image(scene, ray_color, apply_gamma=apply_gamma)
-        self.image = self._convert_to_pil(colors)
+        if self.settings.profile:
+            self.profile = profiler.enable()
+        try:
+            scene = build_world(scene, self.settings.accelerator)
+            accumulator = self._accumulate(scene, ray_color)
+            if self.settings.denoise:
+                with profiler.current().section('denoise'):
+                    accumulator = self._denoise(scene, accumulator)
+        finally:
+            profiler.disable()
+        self.image = None
+        if self.writer is None:
+            self.image = self._convert_to_pil(accumulator.image(apply_gamma))
         return self.image
+
+    def _denoise(self, scene, accumulator):
+        # An accumulator whose means are the denoised colors of accumulator.
+        # The writer, if any, is only opened now: the noisy units are not
+        # streamed to it, so the file never holds anything but the denoised
+        # image.
+        from denoise import aux_buffers, denoise, luminance_variance
+        settings = self.settings
+        colors = denoise(accumulator.mean().interleaved(), luminance_variance(accumulator),
+                         aux_buffers(self, scene), settings.width, settings.height,
+                         settings.denoise_iterations)
+        denoised = Accumulator(accumulator.n_pixels)
+        denoised.sum[:] = Vec3(colors[:, 0], colors[:, 1], colors[:, 2])
+        denoised.count[:] = 1
+        if self.writer:
+            self.writer.open(settings.width, settings.height)
+            self.writer.write(denoised, slice(None))
+            self.writer.close(denoised)
+        return denoised
+
+    def __getstate__(self):
+        # What the render workers need: not the outputs, nor the callbacks
+        state = dict(self.__dict__)
+        for key in ('on_progress', 'writer', 'accumulator', 'image'):
+            state[key] = None
+        return state
     
     def display(self):
         try:
             display(self.image)
             return
         except NameError:
+            from PIL import Image
             if isinstance(self.image, Image.Image):
                 self.image.show()
                 return
@@ -46,39 +145,215 @@ class Renderer(object):
 
     def _convert_to_pil(self, v, scale = 255.999):
         # quick function that can take a Vec3 object and return an Image object.
-        # Our arrays are 3xN, while the Image.fromarray() method expects Nx3,
-        # so we need to swap the axes. The function is able to take 1d or 2d arrays
-        # as an input. It will assume that 1d arrays are grayscale images, and 2d
-        # arrays are composition of 3 grayscale images in RGB order.
-        img = (v.join() * scale).astype(np.uint8)
+        # Image.fromarray() expects the three channels of a pixel next to each
+        # other (HxWx3): interleaved() provides that, without any copy when
+        # the vectors use the packed layout.
+        from PIL import Image
+        img = (v.interleaved() * scale).astype(np.uint8)
+        img_rgb = img.reshape(self.settings.height, self.settings.width, 3)
+        return Image.fromarray(img_rgb)
 
-        if len(img.shape) == 2:
-            img_rgb = img.swapaxes(0,1).reshape(self.settings.height, self.settings.width, 3)
-        else:
-            img_rgb = img.reshape(self.settings.height, self.settings.width)
+    def _tile_size(self, n_pixels):
+        # Pixels per tile of n_pixels to trace, see settings.TILE_SIZE
+        tile_size = self.settings.tile_size
+        if tile_size is None:
+            # Not from the worker count: the tiles key the random streams
+            n_tiles = max(-(-n_pixels // MAX_TILE_SIZE), 1)
+            return max(-(-n_pixels // n_tiles), 1)
+        if tile_size <= 0:
+            return max(n_pixels, 1)
+        return tile_size
 
-        return Image.fromarray(img_rgb)
-    
-    def _compute_image(self, scene, ray_color, apply_gamma=True):
-        ii, jj = np.mgrid[:float(self.settings.height), :float(self.settings.width)]
+    def _tiles(self):
+        # Split the flattened frame into consecutive ranges of pixels. Each
+        # tile is traced independently so the ray batch never exceeds the
+        # tile size, whatever the image resolution.
+        n_pixels = self.settings.width * self.settings.height
+        tile_size = self._tile_size(n_pixels)
+        for start in range(0, n_pixels, tile_size):
+            yield start, min(start + tile_size, n_pixels)
 
-        u = (jj/(self.settings.width-1)).flatten().astype(np.float32)
-        v = (ii/(self.settings.height-1)).flatten().astype(np.float32)
+    def _camera_rays(self, pixels, sample=0, base=None):
+        # One jittered camera ray through each of the given pixels (flat
+        # indices into the frame). sample is the index of the pass (or of
+        # each ray), which the quasi-random jitter patterns follow. base are
+        # the ray_grid() directions of the pixels, looked up here when the
+        # caller has not already done so.
+        if base is None:
+            base = self.camera.ray_grid(self.settings.width, self.settings.height)[pixels]
 
-        img = Vec3.zeros(self.settings.width * self.settings.height)
-        for s in tqdm(range(self.settings.samples_per_pixel)):
-            uu = u + random_uniform(0.0, 1.0, u.size) / (self.settings.width - 1)
-            vv = v + random_uniform(0.0, 1.0, v.size) / (self.settings.height - 1)
+        du, dv = sampling.pixel_jitter(pixels, sample, self.settings.jitter,
+                                       salt=self._entropy & 0xFFFFFFFFFFFFFFFF)
 
-            r = self.camera.get_ray(uu,vv)
+        with profiler.current().section('camera'):
+            return self.camera.get_jittered_rays(base, du, dv)
 
-            img += ray_color(r, scene, self.settings)
+    def _sample_pixels(self, scene, ray_color, pixels, sample=0, base=None):
+        # Trace one camera ray through each of the given pixels and return
+        # their colors
+        return ray_color(self._camera_rays(pixels, sample, base), scene, self.settings)
 
-        img *= 1.0 / self.settings.samples_per_pixel
-        if apply_gamma:
-            img.x = np.sqrt(img.x)
-            img.y = np.sqrt(img.y)
-            img.z = np.sqrt(img.z)
-        return img.clip(0.0, 0.999)
+    def _progressive(self):
+        settings = self.settings
+        return bool(settings.progressive or settings.noise_threshold or settings.time_budget
+                    or settings.preview_every or settings.checkpoint_every)
 
-    
+    def _rounds(self, accumulator, start=0):
+        # Sample passes are grouped in rounds, each yielded with the number
+        # of passes done once it completes: the whole sample budget at once,
+        # or in progressive mode one pass at a time so that the image can be
+        # checked and previewed in between. Adaptive rounds, after the
+        # first min_samples passes, only trace the pixels that are still
+        # noisy. A resumed render starts after its first start passes.
+        settings = self.settings
+        samples = settings.samples_per_pixel
+        if start >= samples:
+            return
+        if not self._progressive():
+            yield samples, self._units(start, samples - start)
+            return
+
+        first = start
+        if settings.adaptive and start < settings.min_samples:
+            first = min(settings.min_samples, samples)
+            yield first, self._units(start, first - start)
+
+        for s in range(first, samples):
+            pixels = None
+            if settings.adaptive:
+                noisy = accumulator.unconverged(settings.noise_threshold, settings.min_samples)
+                pixels = np.flatnonzero(noisy)
+            yield s + 1, self._units(s, 1, pixels)
+
+    def _units(self, first_sample, n_samples, pixels=None):
+        # Work units covering the whole frame tile by tile, or only the
+        # given pixels, split in batches of at most tile_size pixels
+        if pixels is None:
+            return [WorkUnit((index, first_sample), slice(start, stop), n_samples)
+                    for index, (start, stop) in enumerate(self._tiles())]
+
+        tile_size = self._tile_size(pixels.size)
+        return [WorkUnit((index, first_sample), pixels[start:start + tile_size], n_samples)
+                for index, start in enumerate(range(0, pixels.size, tile_size))]
+
+    def _render_unit(self, scene, ray_color, unit, accumulator):
+        # Every sample of a unit draws from its own random stream, keyed by
+        # the unit's tile and the sample index, so the result depends
+        # neither on which process renders it, in which order, nor on how
+        # the samples are grouped into units and rounds.
+        pixels = unit.pixels
+        if isinstance(pixels, slice):
+            pixels = np.arange(pixels.start, pixels.stop)
+        # Base directions of the unit's pixels, shared by all its samples (a
+        # view of the grid for a tile)
+        base = self.camera.ray_grid(self.settings.width, self.settings.height)[unit.pixels]
+        tile, first_sample = unit.key
+        for s in range(unit.n_samples):
+            sampling.seed(self._entropy, tile, first_sample + s, rng=self.settings.rng)
+            colors = self._sample_pixels(scene, ray_color, pixels, first_sample + s, base)
+            accumulator.add(unit.pixels, colors)
+
+    def _engine(self, scene, ray_color):
+        if self.settings.engine not in ENGINES:
+            raise ValueError('unknown engine %r, expected one of %s' % (self.settings.engine, ENGINES))
+        if self.settings.engine == 'wavefront':
+            from wavefront import WavefrontEngine
+            return WavefrontEngine(self, scene, ray_color)
+        if self.settings.engine == 'distributed':
+            from distributed import DistributedEngine
+            return DistributedEngine(self, scene, ray_color)
+        if self.settings.workers > 1:
+            return ProcessPoolEngine(self, scene, ray_color)
+        return SerialEngine(self, scene, ray_color)
+
+    def _done(self, accumulator, passes, started):
+        # Called after each round: report progress and decide whether the
+        # progressive render can stop early
+        settings = self.settings
+        if self.on_progress:
+            self.on_progress(accumulator, passes)
+        if passes >= settings.samples_per_pixel:
+            return True
+
+        if settings.checkpoint_every and passes % settings.checkpoint_every == 0:
+            self.save_checkpoint(accumulator, passes)
+
+        if settings.preview_every and passes % settings.preview_every == 0:
+            self.image = self._convert_to_pil(accumulator.image())
+            self.save('preview.bmp')
+
+        if settings.noise_threshold and passes >= settings.min_samples:
+            if not accumulator.unconverged(settings.noise_threshold, settings.min_samples).any():
+                return True
+        if settings.time_budget and time.time() - started >= settings.time_budget:
+            return True
+        return False
+
+    def _compute_image(self, scene, ray_color, apply_gamma=True):
+        return self._accumulate(scene, ray_color).image(apply_gamma)
+
+    def save_checkpoint(self, accumulator, passes, path=None):
+        '''Save the state of the render after the given number of passes.
+
+        Every sample of a work unit reseeds the random generator from the
+        render's entropy, the unit's tile and the sample index, so the
+        entropy and the passes done are all the random state a resumed
+        render needs to continue with the same streams, whether or not it
+        is progressive.
+        '''
+        path = path or self.settings.checkpoint or DEFAULT_CHECKPOINT
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        accumulator.save(path, passes=passes, entropy=str(self._entropy),
+                         width=self.settings.width, height=self.settings.height)
+
+    def _resume(self):
+        # The accumulator and passes of the checkpoint to resume from
+        settings = self.settings
+        accumulator, metadata = Accumulator.load(settings.resume)
+        if (metadata['width'], metadata['height']) != (settings.width, settings.height):
+            raise ValueError('%s is a %dx%d render, not %dx%d' % (settings.resume,
+                             metadata['width'], metadata['height'], settings.width, settings.height))
+        if metadata['entropy'] is not None:
+            # Merged checkpoints have none, see merge.py
+            self._entropy = int(metadata['entropy'])
+        return accumulator, metadata['passes']
+
+    def _accumulate(self, scene, ray_color):
+        settings = self.settings
+        self._entropy = settings.seed
+        if self._entropy is None:
+            self._entropy = np.random.SeedSequence().entropy
+        resumed, start = None, 0
+        if settings.resume:
+            resumed, start = self._resume()
+
+        # The accumulation buffers are preallocated for the whole frame,
+        # while the rays are only ever created one tile at a time.
+        writer = None if settings.denoise else self.writer
+        on_unit = None
+        if writer:
+            writer.open(settings.width, settings.height)
+        started = time.time()
+        with self._engine(scene, ray_color) as engine, \
+             _progress_bar(settings.samples_per_pixel, start, settings.progress) as progress:
+            passes = start
+            if resumed:
+                engine.accumulator.merge(resumed)
+                del resumed
+                if writer:
+                    for begin, end in self._tiles():
+                        writer.write(engine.accumulator, slice(begin, end))
+            if writer:
+                # Stream the pixels of each unit out as soon as it is done
+                on_unit = lambda unit: writer.write(engine.accumulator, unit.pixels)
+            for passes, units in self._rounds(engine.accumulator, start):
+                engine.run(units, on_unit)
+                progress.update(passes - progress.n)
+                if self._done(engine.accumulator, passes, started):
+                    break
+            if settings.checkpoint:
+                self.save_checkpoint(engine.accumulator, passes)
+        self.accumulator = engine.accumulator
+        if writer:
+            writer.close(self.accumulator)
+        return self.accumulator
@@ -0,0 +1,75 @@
+'''Reproducibility checks.
+
+The random streams of a seeded render are keyed by tile and sample, so
+its statistics must not depend on how the samples are grouped: in one
+round or pass by pass, interrupted and resumed from a checkpoint, split
+in work units of fewer samples or spread over several processes. Each
+check renders a tiny frame both ways and compares the accumulators
+exactly; the script exits with status 1 if any differ:
+
+    python reproducibility.py
+
+Only groupings that add the samples of every pixel in the same order are
+checked: the process pool splitting a tile between workers, or several
+distributed workers, only give the same image up to the rounding of the
+sums.
+'''
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+
+from settings import Settings
+from renderer import Renderer
+from scenes import Scenes
+from color import color_materials
+
+def render(**settings):
+    '''The accumulator of a seeded render of settings'''
+    settings = dict(dict(width=32, samples_per_pixel=4, max_depth=8, seed=7, progress=False), **settings)
+    renderer = Renderer(Settings(**settings))
+    renderer.render(Scenes.world3.value.build(), color_materials)
+    return renderer.accumulator
+
+def same(a, b):
+    return (np.array_equal(a.sum.join(), b.sum.join())
+            and np.array_equal(a.sum_sq, b.sum_sq)
+            and np.array_equal(a.count, b.count))
+
+def checks(directory):
+    '''(name, accumulator, expected accumulator) of every check'''
+    reference = render()
+    yield 'progressive', render(progressive=True), reference
+
+    checkpoint = os.path.join(directory, 'checkpoint.npz')
+    render(samples_per_pixel=2, checkpoint=checkpoint)
+    yield 'resumed', render(resume=checkpoint), reference
+
+    yield 'distributed units', render(engine='distributed', local_workers=1, listen='127.0.0.1:0',
+                                      unit_samples=1), reference
+
+    # Several tiles, one per worker at a time: no tile is split
+    tiled = render(tile_size=96)
+    yield 'workers', render(tile_size=96, workers=2), tiled
+
+def get_command_line_args():
+    parser = ArgumentParser(description='Check that seeded renders do not depend on how their samples are grouped')
+    return parser.parse_args()
+
+def main():
+    np.seterr(invalid='ignore')
+    get_command_line_args()
+    failed = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, accumulator, expected in checks(directory):
+            ok = same(accumulator, expected)
+            print('%-20s %s' % (name, 'ok' if ok else 'DIFFERS'))
+            if not ok:
+                failed.append(name)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+'''Random and quasi-random sampling.
+
+All the random numbers of a render come from a numpy Generator owned by
+this module. seed() gives it the independent stream of a work unit, so a
+unit draws the same numbers whatever the process it runs in.
+
+The samplers are direct (no rejection loop): each sample costs a fixed
+number of uniforms. They fill the Vec3 passed as out, or a new one.
+'''
+import numpy as np
+
+import profiler
+from vec3 import Vec3, scratch
+
+# Bit generators available as Settings.rng
+BIT_GENERATORS = {
+    'pcg64': np.random.PCG64,
+    'philox': np.random.Philox,
+}
+RNG = 'pcg64'
+
+# Pixel jitter patterns, see pixel_jitter()
+JITTERS = ('random', 'halton')
+
+_generator = np.random.Generator(BIT_GENERATORS[RNG]())
+
+def seed(entropy, *key, rng=RNG):
+    '''Draw from now on from the independent stream identified by key'''
+    global _generator
+    if rng not in BIT_GENERATORS:
+        raise ValueError('unknown random generator %r, expected one of %s'
+                         % (rng, tuple(BIT_GENERATORS)))
+    sequence = np.random.SeedSequence(entropy, spawn_key=key)
+    _generator = np.random.Generator(BIT_GENERATORS[rng](sequence))
+
+def generator():
+    return _generator
+
+def uniform(low, high, size, out=None):
+    '''Uniform float32 samples in [low, high)'''
+    with profiler.current().section('rng'):
+        if out is None:
+            out = np.empty(size, dtype=np.float32)
+        _generator.random(size, dtype=np.float32, out=out)
+        if low != 0.0 or high != 1.0:
+            out *= high - low
+            out += low
+        return out
+
+def _out(n, out):
+    return Vec3.empty(n) if out is None else out
+
+def unit_vectors(n, out=None):
+    '''Directions uniformly distributed on the unit sphere'''
+    out = _out(n, out)
+    z = uniform(-1.0, 1.0, n, out=scratch.array('sampling.z', n))
+    phi = uniform(0.0, 2*np.pi, n, out=scratch.array('sampling.phi', n))
+    r = scratch.array('sampling.r', n)
+    np.multiply(z, z, out=r)
+    np.subtract(1.0, r, out=r)
+    np.sqrt(r, out=r)
+    out.z[...] = z
+    np.multiply(r, np.sin(phi), out=out.y)
+    np.multiply(r, np.cos(phi, out=phi), out=out.x)
+    return out
+
+def unit_ball(n, out=None):
+    '''Points uniformly distributed inside the unit sphere'''
+    out = unit_vectors(n, out)
+    # The radius of a uniform point of the ball is distributed as u^(1/3)
+    r = uniform(0.0, 1.0, n, out=scratch.array('sampling.radius', n))
+    np.cbrt(r, out=r)
+    out.x *= r
+    out.y *= r
+    out.z *= r
+    return out
+
+def hemisphere(normal, out=None):
+    '''Unit directions uniformly distributed on the side of each normal'''
+    n = len(normal)
+    out = unit_vectors(n, out)
+    k = out.x*normal.x + out.y*normal.y + out.z*normal.z
+    flip = np.where(k < 0, np.float32(-1.0), np.float32(1.0))
+    out.x *= flip
+    out.y *= flip
+    out.z *= flip
+    return out
+
+def unit_disk(n, out=None):
+    '''Points uniformly distributed inside the unit disk of the z=0 plane'''
+    out = _out(n, out)
+    r = uniform(0.0, 1.0, n, out=scratch.array('sampling.radius', n))
+    np.sqrt(r, out=r)
+    phi = uniform(0.0, 2*np.pi, n, out=scratch.array('sampling.phi', n))
+    np.multiply(r, np.sin(phi), out=out.y)
+    np.multiply(r, np.cos(phi, out=phi), out=out.x)
+    out.z[...] = 0.0
+    return out
+
+def radical_inverse(index, base):
+    '''index-th point of the van der Corput sequence in base'''
+    index = np.asarray(index, dtype=np.int64).copy()
+    result = np.zeros(index.shape, dtype=np.float64)
+    scale = 1.0 / base
+    while index.any():
+        result += (index % base) * scale
+        index //= base
+        scale /= base
+    return result
+
+def _hash_uniform(values, salt):
+    # Stateless uniform in [0, 1) per value: a splitmix64 finalizer
+    with np.errstate(over='ignore'):
+        z = values.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) + np.uint64(salt)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(40)).astype(np.float32) * np.float32(1.0 / 16777216.0)
+
+def pixel_jitter(pixels, sample, pattern='random', salt=0):
+    '''Sub-pixel offsets in [0, 1)^2 of the sample-th ray of each pixel.
+
+    random: independent uniforms.
+    halton: the sample-th point of the 2D Halton sequence (bases 2 and 3),
+    which covers the pixel more evenly than random points so the image
+    converges in fewer samples. Each pixel gets its own random
+    (Cranley-Patterson) shift of the sequence, derived from salt, so
+    neighbouring pixels do not share the same structured error.
+    '''
+    n = len(pixels)
+    if pattern == 'random':
+        return uniform(0.0, 1.0, n), uniform(0.0, 1.0, n)
+    if pattern != 'halton':
+        raise ValueError('unknown jitter pattern %r, expected one of %s' % (pattern, JITTERS))
+
+    du = _hash_uniform(pixels, salt)
+    dv = _hash_uniform(pixels, salt ^ 0x5851F42D4C957F2D)
+    du += np.float32(radical_inverse(sample, 2))
+    dv += np.float32(radical_inverse(sample, 3))
+    return du % 1.0, dv % 1.0
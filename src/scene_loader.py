@@ -0,0 +1,169 @@
+'''Scenes described in JSON or TOML files.
+
+A scene file lists its materials by name, its spheres and optionally the
+camera:
+
+    {
+        "camera": {"origin": [0, 0.5, 1], "look_at": [0, 0, -1]},
+        "materials": {
+            "ground": {"type": "lambertian", "albedo": [0.8, 0.8, 0.0]},
+            "mirror": {"type": "metal", "albedo": [0.8, 0.8, 0.8], "fuzz": 0.1}
+        },
+        "spheres": [
+            {"center": [0, -100.5, -1], "radius": 100, "material": "ground"},
+            {"center": [0, 0, -1], "radius": 0.5, "material": "mirror"}
+        ]
+    }
+
+Large generated scenes can give the spheres as columns instead, which
+parse much faster:
+
+    "spheres": {"center": [[0, -100.5, -1], [0, 0, -1]],
+                "radius": [100, 0.5],
+                "material": ["ground", "mirror"]}
+
+The camera accepts origin, look_at, vup, viewport_height and
+focal_length. The spheres are compiled straight from these arrays into a
+SphereSet or a BVH (see accelerators), and the compiled world is cached on
+disk under the hash of the file's content: loading the same file again
+skips the parsing and the BVH construction.
+'''
+import os
+import json
+import pickle
+import hashlib
+from collections import namedtuple
+
+import numpy as np
+
+from vec3 import Point3, Color
+from hittable import HittableList, SphereSet
+from material import Lambertian, Metal
+from bvh import BVH
+from accelerators import ACCELERATORS, AUTO_SPHERESET_MAX
+
+# Compiled scenes are cached in this directory
+CACHE_DIR = os.environ.get('RAYTRACE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'raytrace'))
+# Part of the cache key: bump it when the compiled classes change
+CACHE_VERSION = 3
+
+# world: the compiled Hittable
+# settings: the Settings keyword arguments given by the camera section
+SceneFile = namedtuple('SceneFile', 'world settings')
+
+MATERIALS = {
+    'lambertian': lambda m: Lambertian(Color(*m['albedo'])),
+    'metal': lambda m: Metal(Color(*m['albedo']), m.get('fuzz', 0.0)),
+}
+
+# Settings keyword of each camera entry, and whether it is a point
+CAMERA = {
+    'origin': ('camera_origin', True),
+    'look_at': ('camera_look_at', True),
+    'vup': ('camera_vup', True),
+    'viewport_height': ('viewport_height', False),
+    'focal_length': ('focal_length', False),
+}
+
+def parse(data, path='<scene>'):
+    '''The spheres (a SphereSet) and camera settings of a scene description'''
+    names = list(data.get('materials', {}))
+    materials = []
+    for name in names:
+        m = data['materials'][name]
+        if m.get('type') not in MATERIALS:
+            raise ValueError('%s: material %r has unknown type %r, expected one of %s'
+                             % (path, name, m.get('type'), tuple(MATERIALS)))
+        materials.append(MATERIALS[m['type']](m))
+    index = {name: i for i, name in enumerate(names)}
+
+    spheres = data.get('spheres', [])
+    if isinstance(spheres, dict):
+        center, radius, material = spheres['center'], spheres['radius'], spheres['material']
+    else:
+        center = [s['center'] for s in spheres]
+        radius = [s['radius'] for s in spheres]
+        material = [s['material'] for s in spheres]
+    try:
+        material_index = [index[name] for name in material]
+    except KeyError as e:
+        raise ValueError('%s: undefined material %s' % (path, e))
+    spheres = SphereSet.from_arrays(np.array(center, dtype=np.float32).reshape(-1, 3),
+                                    radius, material_index, materials)
+
+    settings = {}
+    for key, value in data.get('camera', {}).items():
+        if key not in CAMERA:
+            raise ValueError('%s: unknown camera setting %r' % (path, key))
+        name, is_point = CAMERA[key]
+        settings[name] = Point3(*value) if is_point else value
+    return spheres, settings
+
+def compile_spheres(spheres, accelerator='auto'):
+    '''A SphereSet compiled into the given structure, see accelerators'''
+    if accelerator not in ACCELERATORS:
+        raise ValueError('unknown accelerator %r, expected one of %s' % (accelerator, tuple(ACCELERATORS)))
+    if accelerator == 'auto':
+        accelerator = 'sphereset' if len(spheres) <= AUTO_SPHERESET_MAX else 'bvh'
+    if accelerator == 'list':
+        return HittableList(spheres.spheres())
+    if accelerator == 'bvh':
+        return BVH(spheres)
+    return spheres
+
+def read(path, content):
+    if path.endswith('.toml'):
+        import tomllib
+        return tomllib.loads(content.decode('utf-8'))
+    return json.loads(content)
+
+def scene_key(content, accelerator='auto'):
+    '''Hash of the content of a scene file compiled with accelerator'''
+    return hashlib.sha256(b'%d:%s:' % (CACHE_VERSION, accelerator.encode()) + content).hexdigest()
+
+def load_scene(path, accelerator='auto', cache=True, content=None):
+    '''The compiled world and camera settings of a scene file (SceneFile).
+    content is the file's bytes, when the caller has already read them.'''
+    if content is None:
+        with open(path, 'rb') as f:
+            content = f.read()
+
+    cached = os.path.join(CACHE_DIR, scene_key(content, accelerator) + '.pickle')
+    if cache and os.path.exists(cached):
+        with open(cached, 'rb') as f:
+            return pickle.load(f)
+
+    spheres, settings = parse(read(path, content), path)
+    scene = SceneFile(compile_spheres(spheres, accelerator), settings)
+
+    if cache:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = cached + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            pickle.dump(scene, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cached)
+    return scene
+
+def save_scene(path, objects, camera=None):
+    '''Write a list of spheres (e.g. a Scenes entry) as a JSON scene file,
+    with the spheres as columns'''
+    spheres = SphereSet(objects)
+    names = ['m%d' % i for i in range(len(spheres.materials()))]
+    materials = {}
+    for name, m in zip(names, spheres.materials()):
+        a = m.albedo
+        materials[name] = {'type': type(m).__name__.lower(), 'albedo': [float(a.x), float(a.y), float(a.z)]}
+        if isinstance(m, Metal):
+            materials[name]['fuzz'] = float(m.fuzz)
+    data = {
+        'materials': materials,
+        'spheres': {
+            'center': spheres.center.interleaved().tolist(),
+            'radius': spheres.radius.tolist(),
+            'material': [names[i] for i in spheres.material_index],
+        },
+    }
+    if camera:
+        data['camera'] = camera
+    with open(path, 'w') as f:
+        json.dump(data, f)
@@ -1,4 +1,5 @@
 from enum import Enum
+import numpy as np
 from vec3 import Vec3, Point3, Color, unit_vector, dot, cross, length, length_squared
 from hittable import HitRecord, Sphere
 from material import Lambertian, Metal
@@ -7,34 +8,68 @@ from color import img_centre
 ####
 # Set up scene
 ####
-diffuse_mat = Lambertian(Color(0, 0, .3))
-metal_mat = Metal(Color(.3, .1, .1))
-world1 = [Sphere(img_centre, 0.5, diffuse_mat), Sphere(Point3(0, -100.5, -1), 100, diffuse_mat), Sphere(Point3(0.5, 0.25, -1), 0.25, metal_mat)]
+# Scenes are built on demand by these functions, not when the module is
+# imported: listing the scenes costs nothing, and only the one rendered is
+# constructed.
+def world1():
+    diffuse_mat = Lambertian(Color(0, 0, .3))
+    metal_mat = Metal(Color(.3, .1, .1))
+    return [Sphere(img_centre, 0.5, diffuse_mat), Sphere(Point3(0, -100.5, -1), 100, diffuse_mat), Sphere(Point3(0.5, 0.25, -1), 0.25, metal_mat)]
 
-material_ground = Lambertian(Color(0.8, 0.8, 0.0))
-material_center = Lambertian(Color(0.7, 0.3, 0.3))
-material_left   = Metal(Color(0.8, 0.8, 0.8))
-material_right  = Metal(Color(0.8, 0.6, 0.2))
+def world2():
+    material_ground = Lambertian(Color(0.8, 0.8, 0.0))
+    material_center = Lambertian(Color(0.7, 0.3, 0.3))
+    material_left   = Metal(Color(0.8, 0.8, 0.8))
+    material_right  = Metal(Color(0.8, 0.6, 0.2))
 
-world2 = [
-    Sphere(Point3( 0.0, -100.5, -1.0), 100.0, material_ground),
-    Sphere(Point3( 0.0,    0.0, -1.0),   0.5, material_center),
-    Sphere(Point3(-1.0,    0.0, -1.0),   0.5, material_left),
-    Sphere(Point3( 1.0,    0.0, -1.0),   0.5, material_right),
-]
+    return [
+        Sphere(Point3( 0.0, -100.5, -1.0), 100.0, material_ground),
+        Sphere(Point3( 0.0,    0.0, -1.0),   0.5, material_center),
+        Sphere(Point3(-1.0,    0.0, -1.0),   0.5, material_left),
+        Sphere(Point3( 1.0,    0.0, -1.0),   0.5, material_right),
+    ]
 
-material_left   = Metal(Color(0.8, 0.8, 0.8), 0.3)
-material_right  = Metal(Color(0.8, 0.6, 0.2), 1.0)
+def world3():
+    material_ground = Lambertian(Color(0.8, 0.8, 0.0))
+    material_center = Lambertian(Color(0.7, 0.3, 0.3))
+    material_left   = Metal(Color(0.8, 0.8, 0.8), 0.3)
+    material_right  = Metal(Color(0.8, 0.6, 0.2), 1.0)
 
-world3 = [
-    Sphere(Point3( 0.0, -100.5, -1.0), 100.0, material_ground),
-    Sphere(Point3( 0.0,    0.0, -1.0),   0.5, material_center),
-    Sphere(Point3(-1.0,    0.0, -1.0),   0.5, material_left),
-    Sphere(Point3( 1.0,    0.0, -1.0),   0.5, material_right),
-]
+    return [
+        Sphere(Point3( 0.0, -100.5, -1.0), 100.0, material_ground),
+        Sphere(Point3( 0.0,    0.0, -1.0),   0.5, material_center),
+        Sphere(Point3(-1.0,    0.0, -1.0),   0.5, material_left),
+        Sphere(Point3( 1.0,    0.0, -1.0),   0.5, material_right),
+    ]
 
+def random_spheres(seed=0):
+    '''The book's final scene: a field of small random spheres on a large
+    ground sphere, shifted in front of our fixed camera'''
+    rng = np.random.RandomState(seed)
+    world = [Sphere(Point3(0, -1000.5, -1), 1000, Lambertian(Color(0.5, 0.5, 0.5)))]
+
+    for a in range(-11, 11):
+        for b in range(-11, 11):
+            choose_mat = rng.uniform()
+            center = Point3(a + 0.9*rng.uniform(), -0.3, b - 12 + 0.9*rng.uniform())
+            if choose_mat < 0.8:
+                albedo = Color(*(rng.uniform(size=3) * rng.uniform(size=3)))
+                material = Lambertian(albedo)
+            else:
+                albedo = Color(*rng.uniform(0.5, 1, size=3))
+                material = Metal(albedo, rng.uniform(0, 0.5))
+            world.append(Sphere(center, 0.2, material))
+
+    world.append(Sphere(Point3(-4, 0.5, -8), 1.0, Lambertian(Color(0.4, 0.2, 0.1))))
+    world.append(Sphere(Point3( 0, 0.5, -8), 1.0, Metal(Color(0.7, 0.6, 0.5), 0.0)))
+    return world
+
+class Scene(object):
+    def __init__(self, build):
+        self.build = build
 
 class Scenes(Enum):
-    world1 = world1
-    world2 = world2
-    world3 = world3
+    world1 = Scene(world1)
+    world2 = Scene(world2)
+    world3 = Scene(world3)
+    random_spheres = Scene(random_spheres)
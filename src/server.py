@@ -0,0 +1,349 @@
+'''Local render service.
+
+A long running HTTP server (asyncio, no dependencies) that queues render
+jobs and runs them on a pool of warm worker processes: the imports, the
+scenes and their compiled worlds are paid for once per worker, not once
+per request.
+
+    python server.py [--port 8765] [--workers 2] [--max-queue 16]
+                     [--keep-jobs 64] [--scenes-dir scenes]
+
+    POST   /jobs             submit a job, returns its id
+    GET    /jobs             status of all the jobs
+    GET    /jobs/<id>        status of a job
+    GET    /jobs/<id>/image  PNG of the result, or of the latest preview
+                             while the job runs
+    DELETE /jobs/<id>        cancel a queued or running job
+
+A job is a JSON object:
+
+    {"scene": "world3",              (or "scene_file": "path.json", under
+                                      --scenes-dir)
+     "shader": "color_materials",
+     "settings": {"width": 400, "samples_per_pixel": 64},
+     "preview_every": 4}             (PNG preview every 4 passes, 0 for none)
+
+posted with Content-Type: application/json. Only the settings of
+SETTINGS can be given: nothing a client sends picks files or addresses
+on the server.
+
+--workers jobs run at the same time, each on one process; up to
+--max-queue more wait for a worker, and further submissions are refused
+with 503 until the queue drains. The results of the last --keep-jobs
+finished jobs are kept, older ones are forgotten.
+'''
+import io
+import os
+import json
+import asyncio
+import itertools
+import multiprocessing
+from argparse import ArgumentParser
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+HOST = '127.0.0.1'
+PORT = 8765
+WORKERS = 2
+MAX_QUEUE = 16
+KEEP_JOBS = 64
+# Compiled worlds each worker keeps, the least recently used are dropped
+KEEP_WORLDS = 4
+
+# Settings a job may give, all of them about the image only
+SETTINGS = ('aspect_ratio', 'width', 'samples_per_pixel', 'max_depth', 'russian_roulette',
+            'roulette_depth', 'camera_origin', 'camera_look_at', 'camera_vup', 'viewport_height',
+            'focal_length', 'tile_size', 'seed', 'rng', 'jitter', 'accelerator', 'noise_threshold',
+            'min_samples', 'adaptive', 'time_budget', 'denoise', 'denoise_iterations')
+
+class Cancelled(Exception):
+    pass
+
+# Per-process state of a render worker, set up once by _init_worker
+_worker = {}
+
+def _init_worker(progress, cancelled):
+    np.seterr(invalid='ignore')
+    # Warm up: everything a job needs is imported before the first one
+    import renderer, scenes, color_types, scene_loader
+    _worker['progress'] = progress
+    _worker['cancelled'] = cancelled
+    _worker['worlds'] = OrderedDict()
+
+def _png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def _world(job, accelerator):
+    # The last KEEP_WORLDS compiled worlds stay in the worker, keyed by scene and
+    # accelerator, scene files by the hash of their content: an edited
+    # file is compiled again. Scene files come with their camera settings.
+    from accelerators import build_world
+    from scenes import Scenes
+    from scene_loader import load_scene, scene_key
+
+    content = None
+    if job.get('scene_file'):
+        with open(job['scene_file'], 'rb') as f:
+            content = f.read()
+        key = scene_key(content, accelerator)
+    else:
+        key = (job.get('scene', 'world3'), accelerator)
+    worlds = _worker['worlds']
+    world = worlds.get(key)
+    if world is None:
+        if content is not None:
+            world = load_scene(job['scene_file'], accelerator, content=content)
+        else:
+            world = (build_world(Scenes[job.get('scene', 'world3')].value.build(), accelerator), {})
+        worlds[key] = world
+        while len(worlds) > KEEP_WORLDS:
+            worlds.popitem(last=False)
+    worlds.move_to_end(key)
+    return world
+
+def _render_job(job_id, job):
+    from settings import Settings
+    from renderer import Renderer
+    from color_types import Colors
+
+    progress = _worker['progress']
+    cancelled = _worker['cancelled']
+    if job_id in cancelled:
+        raise Cancelled()
+
+    settings = {name: value for name, value in job.get('settings', {}).items() if name in SETTINGS}
+    # Frames are the unit of parallelism of the server, and results only
+    # go back to the client
+    settings.update(workers=1, engine='passes', local_workers=0, progress=False, progressive=True,
+                    output=None, accumulator_file=None, checkpoint=None, checkpoint_every=0,
+                    resume=None, preview_every=0)
+    world, camera = _world(job, settings.get('accelerator', 'auto'))
+    settings = Settings.from_dict(settings)
+    for name, value in camera.items():
+        setattr(settings, name, value)
+    preview_every = job.get('preview_every', 0)
+    preview = None
+
+    def on_progress(accumulator, passes):
+        # Called after every sample pass: the cancellation point
+        nonlocal preview
+        if job_id in cancelled:
+            raise Cancelled()
+        if preview_every and passes % preview_every == 0:
+            preview = _png(renderer._convert_to_pil(accumulator.image()))
+        progress[job_id] = (passes, preview)
+
+    renderer = Renderer(settings, on_progress=on_progress)
+    image = renderer.render(world, Colors[job.get('shader', 'color_materials')].value.function)
+    return _png(image)
+
+class Job:
+    def __init__(self, job_id, spec):
+        self.id = job_id
+        self.spec = spec
+        self.status = 'queued'
+        self.error = None
+        self.png = None
+        # Passes done, once the job has ended
+        self.passes = 0
+
+    def to_dict(self, progress):
+        passes, _ = progress.get(self.id, (self.passes, None))
+        return {'id': self.id, 'status': self.status, 'passes': passes,
+                'samples_per_pixel': self.spec.get('settings', {}).get('samples_per_pixel'),
+                'error': self.error}
+
+class RenderServer:
+    def __init__(self, workers=WORKERS, max_queue=MAX_QUEUE, keep_jobs=KEEP_JOBS, scenes_dir=None):
+        self.workers = workers
+        self.keep_jobs = keep_jobs
+        # Scene files can only be read from this directory (None for none)
+        self.scenes_dir = scenes_dir and os.path.realpath(scenes_dir)
+        self._manager = multiprocessing.Manager()
+        # Shared with the workers: (passes, preview PNG) of the running
+        # jobs, and the ids of the cancelled ones
+        self.progress = self._manager.dict()
+        self.cancelled = self._manager.dict()
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                        initargs=(self.progress, self.cancelled))
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.jobs = {}
+        # Ids of the ended jobs, oldest first
+        self._ended = deque()
+        self._ids = itertools.count(1)
+
+    def submit(self, spec):
+        if not isinstance(spec, dict) or not isinstance(spec.get('settings', {}), dict):
+            raise ValueError('a job is a JSON object, and its settings too')
+        unknown = set(spec.get('settings', {})) - set(SETTINGS)
+        if unknown:
+            raise ValueError('settings %s cannot be given, expected some of %s'
+                             % (', '.join(sorted(unknown)), ', '.join(SETTINGS)))
+        if self.queue.full():
+            raise asyncio.QueueFull()
+        if spec.get('scene_file'):
+            spec = dict(spec, scene_file=self._scene_path(spec['scene_file']))
+        job = Job(str(next(self._ids)), spec)
+        self.queue.put_nowait(job)
+        self.jobs[job.id] = job
+        return job
+
+    def _scene_path(self, name):
+        # The path of a scene file of the scenes directory
+        if self.scenes_dir is None:
+            raise ValueError('scene files are disabled, start the server with --scenes-dir')
+        path = os.path.realpath(os.path.join(self.scenes_dir, name))
+        if os.path.commonpath([path, self.scenes_dir]) != self.scenes_dir or not os.path.isfile(path):
+            raise ValueError('no scene file %s in the scenes directory' % name)
+        return path
+
+    def cancel(self, job):
+        if job.status == 'queued':
+            self._end(job, 'cancelled')
+        elif job.status == 'running':
+            self.cancelled[job.id] = True
+
+    def _end(self, job, status):
+        # Keep what is left of the job in this process only, and forget the
+        # oldest ended jobs beyond keep_jobs
+        passes, _ = self.progress.pop(job.id, (job.passes, None))
+        job.passes = passes
+        job.status = status
+        self.cancelled.pop(job.id, None)
+        self._ended.append(job.id)
+        while len(self._ended) > self.keep_jobs:
+            self.jobs.pop(self._ended.popleft(), None)
+
+    async def dispatch(self):
+        # One dispatcher per worker: a job leaves the queue only when a
+        # process is free to render it
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            if job.status != 'queued':
+                continue
+            job.status = 'running'
+            try:
+                job.png = await loop.run_in_executor(self.pool, _render_job, job.id, job.spec)
+                self._end(job, 'done')
+            except Cancelled:
+                self._end(job, 'cancelled')
+            except Exception as e:
+                job.error = '%s: %s' % (type(e).__name__, e)
+                self._end(job, 'failed')
+
+    def image(self, job):
+        if job.png is not None:
+            return job.png
+        return self.progress.get(job.id, (0, None))[1]
+
+    async def handle(self, reader, writer):
+        try:
+            status, body, content_type = await self._route(reader)
+        except Exception as e:
+            status, body, content_type = 400, _json({'error': str(e)}), 'application/json'
+        writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                     % (status, REASONS[status].encode(), content_type.encode(), len(body)))
+        writer.write(body)
+        await writer.drain()
+        writer.close()
+
+    async def _route(self, reader):
+        request = (await reader.readline()).decode('latin-1').split()
+        if len(request) < 2:
+            raise ValueError('malformed request')
+        method, path = request[0], request[1].rstrip('/')
+        length = 0
+        content_type = ''
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            name = name.strip().lower()
+            if name == 'content-length':
+                length = int(value)
+            elif name == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+        body = await reader.readexactly(length) if length else b''
+
+        parts = path.strip('/').split('/')
+        if parts[0] != 'jobs':
+            return 404, _json({'error': 'not found'}), 'application/json'
+        if len(parts) == 1:
+            if method == 'POST':
+                # Not a form or text/plain: a web page cannot post a job
+                # without the browser asking the server first
+                if content_type != 'application/json':
+                    return 415, _json({'error': 'jobs are posted as application/json'}), 'application/json'
+                try:
+                    job = self.submit(json.loads(body or b'{}'))
+                except asyncio.QueueFull:
+                    return 503, _json({'error': 'queue full'}), 'application/json'
+                return 202, _json(job.to_dict(self.progress)), 'application/json'
+            if method == 'GET':
+                return 200, _json([j.to_dict(self.progress) for j in self.jobs.values()]), 'application/json'
+            return 405, _json({'error': 'method not allowed'}), 'application/json'
+
+        job = self.jobs.get(parts[1])
+        if job is None:
+            return 404, _json({'error': 'no job %s' % parts[1]}), 'application/json'
+        if len(parts) == 3 and parts[2] == 'image' and method == 'GET':
+            png = self.image(job)
+            if png is None:
+                return 404, _json({'error': 'no image yet'}), 'application/json'
+            return 200, png, 'image/png'
+        if len(parts) == 2 and method == 'GET':
+            return 200, _json(job.to_dict(self.progress)), 'application/json'
+        if len(parts) == 2 and method == 'DELETE':
+            self.cancel(job)
+            return 200, _json(job.to_dict(self.progress)), 'application/json'
+        return 404, _json({'error': 'not found'}), 'application/json'
+
+    async def serve(self, host=HOST, port=PORT):
+        # Start the workers now rather than on the first request
+        await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(self.pool, abs, 0)
+                               for _ in range(self.workers)])
+        dispatchers = [asyncio.create_task(self.dispatch()) for _ in range(self.workers)]
+        server = await asyncio.start_server(self.handle, host, port)
+        print('serving on http://%s:%d with %d workers' % (host, port, self.workers), flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in dispatchers:
+                task.cancel()
+            self.pool.shutdown(cancel_futures=True)
+            self._manager.shutdown()
+
+REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 415: 'Unsupported Media Type', 503: 'Service Unavailable'}
+
+def _json(data):
+    return json.dumps(data).encode()
+
+def get_command_line_args():
+    parser = ArgumentParser(description='Serve render jobs over HTTP')
+    parser.add_argument('--host', type=str, help='address to listen on (default 127.0.0.1)', default=HOST)
+    parser.add_argument('--port', type=int, help='port to listen on (default 8765)', default=PORT)
+    parser.add_argument('--workers', type=int, help='jobs rendered at the same time (default 2)', default=WORKERS)
+    parser.add_argument('--max-queue', type=int, help='jobs waiting for a worker before submissions are refused (default 16)', default=MAX_QUEUE)
+    parser.add_argument('--keep-jobs', type=int, help='ended jobs whose status and image are kept (default 64)', default=KEEP_JOBS)
+    parser.add_argument('--scenes-dir', type=str, help='directory the scene files of jobs are read from (default none: scene files are refused)', default=None)
+    return parser.parse_args()
+
+def main():
+    args = get_command_line_args()
+    async def run():
+        await RenderServer(args.workers, args.max_queue, args.keep_jobs, args.scenes_dir).serve(args.host, args.port)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
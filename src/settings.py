@@ -1,4 +1,5 @@
-from vec3 import Point3
+from vec3 import Point3, get_layout
+import sampling
 
 # Default values
 ASPECT_RATIO = 16.0/9.0
@@ -8,31 +9,212 @@ WIDTH = 400
 SAMPLES_PER_PIXEL = 10
 MAX_DEPTH = 50
 
+# Randomly stop the dim paths once they have bounced roulette_depth times
+# (the image stays unbiased), see color._roulette()
+RUSSIAN_ROULETTE = False
+ROULETTE_DEPTH = 3
+
+# Render default values
+# Number of rays traced together in one batch. Peak memory is bounded by the
+# tile size rather than by the image size. Every tile pays the fixed cost of
+# each bounce of the shader, so fewer, larger tiles render faster: None
+# splits the frame into as few equal tiles of at most MAX_TILE_SIZE as it
+# can, whatever the number of workers, so that a seed gives the same image
+# with any. 0 traces the whole frame at once.
+TILE_SIZE = None
+MAX_TILE_SIZE = 262144
+# Number of worker processes. 1 renders in the current process.
+WORKERS = 1
+# How the work units are traced, see renderer.ENGINES
+ENGINE = 'passes'
+# Paths in flight in the wavefront engine, see wavefront
+WAVEFRONT_SIZE = 65536
+# Distributed engine, see distributed: address the coordinator listens on
+# for workers, worker processes it starts itself, samples per work unit
+# (0 for whole tiles) and seconds before the unit of a silent worker is
+# handed out again (None to wait for its connection to drop)
+LISTEN = '127.0.0.1:8766'
+LOCAL_WORKERS = 0
+UNIT_SAMPLES = 8
+UNIT_TIMEOUT = None
+# Random seed. None seeds from fresh entropy on every render.
+SEED = None
+# Random bit generator, see sampling.BIT_GENERATORS
+RNG = sampling.RNG
+# Sub-pixel jitter of the camera rays, see sampling.pixel_jitter()
+JITTER = 'random'
+# Structure the scene is compiled into, see accelerators.ACCELERATORS
+ACCELERATOR = 'auto'
+# Show a progress bar while rendering
+PROGRESS = True
+# Record per-bounce statistics and timings, see profiler
+PROFILE = False
+# Memory layout of the vectors, see vec3.set_layout(). Defaults to the
+# RAYTRACE_VEC3_LAYOUT environment variable, else planar.
+VEC3_LAYOUT = get_layout()
+
+# Output file written as the frame renders, see writers.get_writer(). None
+# keeps the image in memory.
+OUTPUT = None
+# Memory-map the sample accumulator to this .npy file (None keeps it in memory)
+ACCUMULATOR_FILE = None
+
+# Checkpoint file saved at the end of the render and, every checkpoint_every
+# sample passes, during it (None and 0 for none). resume is a checkpoint to
+# continue from.
+CHECKPOINT = None
+CHECKPOINT_EVERY = 0
+RESUME = None
+# Checkpoint file used when only checkpoint_every is given
+DEFAULT_CHECKPOINT = 'images/checkpoint.npz'
+
+# Progressive rendering default values
+# Render one sample pass per round, reporting each to on_progress, even
+# without any of the stopping criteria below
+PROGRESSIVE = False
+# Stop once the standard error of every pixel's luminance is below this
+# (linear units, None to always render all samples)
+NOISE_THRESHOLD = None
+# Samples a pixel needs before its noise estimate is trusted
+MIN_SAMPLES = 8
+# Only trace the pixels that are still noisy after min_samples passes
+ADAPTIVE = False
+# Noise threshold used by adaptive sampling when none is given
+ADAPTIVE_NOISE_THRESHOLD = 0.02
+# Stop after this many seconds (None for no limit)
+TIME_BUDGET = None
+# Save a preview image every this many sample passes (0 for none)
+PREVIEW_EVERY = 0
+
+# Filter the noise out of the final image, see denoise
+DENOISE = False
+DENOISE_ITERATIONS = 5
+
 # Camera Default Values
 ORIGIN = Point3(0, 0, 0)
+# Point the camera looks at (None to look down -z) and its up direction
+LOOK_AT = None
+VUP = Point3(0, 1, 0)
 VIEWPORT_HEIGHT = 2.0
 FOCAL_LENGTH = 1.0
 
 class Settings(object):
+    # Settings given as points
+    POINTS = ('camera_origin', 'camera_look_at', 'camera_vup')
+
     def __init__(self,
                  aspect_ratio=ASPECT_RATIO,
                  width=WIDTH,
                  samples_per_pixel=SAMPLES_PER_PIXEL,
                  max_depth=MAX_DEPTH,
+                 russian_roulette=RUSSIAN_ROULETTE,
+                 roulette_depth=ROULETTE_DEPTH,
                  camera_origin=ORIGIN,
+                 camera_look_at=LOOK_AT,
+                 camera_vup=VUP,
                  viewport_height=VIEWPORT_HEIGHT,
-                 focal_length=FOCAL_LENGTH):
+                 focal_length=FOCAL_LENGTH,
+                 tile_size=TILE_SIZE,
+                 workers=WORKERS,
+                 engine=ENGINE,
+                 wavefront_size=WAVEFRONT_SIZE,
+                 listen=LISTEN,
+                 local_workers=LOCAL_WORKERS,
+                 unit_samples=UNIT_SAMPLES,
+                 unit_timeout=UNIT_TIMEOUT,
+                 seed=SEED,
+                 rng=RNG,
+                 jitter=JITTER,
+                 accelerator=ACCELERATOR,
+                 vec3_layout=VEC3_LAYOUT,
+                 progress=PROGRESS,
+                 profile=PROFILE,
+                 output=OUTPUT,
+                 accumulator_file=ACCUMULATOR_FILE,
+                 checkpoint=CHECKPOINT,
+                 checkpoint_every=CHECKPOINT_EVERY,
+                 resume=RESUME,
+                 progressive=PROGRESSIVE,
+                 noise_threshold=NOISE_THRESHOLD,
+                 min_samples=MIN_SAMPLES,
+                 time_budget=TIME_BUDGET,
+                 preview_every=PREVIEW_EVERY,
+                 adaptive=ADAPTIVE,
+                 denoise=DENOISE,
+                 denoise_iterations=DENOISE_ITERATIONS):
         # image default values
         self.aspect_ratio = aspect_ratio
         self.width = width
         self.height = self._get_height()
         self.samples_per_pixel = samples_per_pixel
         self.max_depth = max_depth
+        self.russian_roulette = russian_roulette
+        self.roulette_depth = roulette_depth
 
         # camera default values
         self.camera_origin = camera_origin
+        self.camera_look_at = camera_look_at
+        self.camera_vup = camera_vup
         self.viewport_height = viewport_height
         self.focal_length = focal_length
 
+        # render default values
+        self.tile_size = tile_size
+        self.workers = workers
+        self.engine = engine
+        self.wavefront_size = wavefront_size
+        self.listen = listen
+        self.local_workers = local_workers
+        self.unit_samples = unit_samples
+        self.unit_timeout = unit_timeout
+        self.seed = seed
+        self.rng = rng
+        self.jitter = jitter
+        self.accelerator = accelerator
+        self.vec3_layout = vec3_layout
+        self.progress = progress
+        self.profile = profile
+        self.output = output
+        self.accumulator_file = accumulator_file
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.resume = resume
+        if checkpoint_every and checkpoint is None:
+            self.checkpoint = DEFAULT_CHECKPOINT
+
+        # progressive rendering default values
+        self.progressive = progressive
+        self.noise_threshold = noise_threshold
+        self.min_samples = min_samples
+        self.time_budget = time_budget
+        self.preview_every = preview_every
+        self.adaptive = adaptive
+        if adaptive and noise_threshold is None:
+            self.noise_threshold = ADAPTIVE_NOISE_THRESHOLD
+
+        # denoising default values
+        self.denoise = denoise
+        self.denoise_iterations = denoise_iterations
+
     def _get_height(self):
         return int(self.width / self.aspect_ratio)
+
+    def to_dict(self):
+        '''The keyword arguments of these settings, as plain JSON types'''
+        d = dict(vars(self))
+        del d['height']
+        for key in self.POINTS:
+            p = d[key]
+            if p is not None:
+                d[key] = [float(p.x), float(p.y), float(p.z)]
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        '''Settings from keyword arguments, with points given as [x, y, z]'''
+        d = dict(d)
+        d.pop('height', None)
+        for key in cls.POINTS:
+            if d.get(key) is not None:
+                d[key] = Point3(*d[key])
+        return cls(**d)
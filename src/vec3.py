@@ -1,44 +1,88 @@
+import os
 import numpy as np
 
+# Memory layout of the vectors created by the Vec3 factories (empty, zeros,
+# ones and the scratch workspace), see set_layout()
+LAYOUTS = ('planar', 'packed')
+_layout = os.environ.get('RAYTRACE_VEC3_LAYOUT', 'planar')
+
+def set_layout(layout):
+    '''Select how new vectors are stored.
+
+    planar: x, y and z are three separate arrays (Vec3)
+    packed: a single contiguous (N, 3) array, x, y and z are views into it
+            (PackedVec3)
+
+    Both expose the same interface, so call sites do not change.
+    '''
+    global _layout
+    if layout not in LAYOUTS:
+        raise ValueError('unknown Vec3 layout %r, expected one of %s' % (layout, LAYOUTS))
+    _layout = layout
+
+def get_layout():
+    return _layout
+
+def _packed_shape(size):
+    return (size, 3) if np.isscalar(size) else tuple(size) + (3,)
+
 class Vec3:
-    def __init__(self, x=0.0, y=0.0, z=0.0):
-        self.x = np.array(x, dtype=np.float32)
-        self.y = np.array(y, dtype=np.float32)
-        self.z = np.array(z, dtype=np.float32)
+    def __init__(self, x=0.0, y=0.0, z=0.0, copy=True):
+        # copy=False: components that already are float32 arrays are used as
+        # is, see wrap()
+        array = np.array if copy else np.asarray
+        self.x = array(x, dtype=np.float32)
+        self.y = array(y, dtype=np.float32)
+        self.z = array(z, dtype=np.float32)
+
+    @staticmethod
+    def wrap(x, y, z):
+        '''A Vec3 of the given components without copying them: float32
+        arrays are shared with the caller, which saves a copy for every
+        operator result but makes writes through either visible in both'''
+        return Vec3(x, y, z, copy=False)
 
     @staticmethod
     def empty(size):
+        if _layout == 'packed':
+            return PackedVec3(np.empty(_packed_shape(size), dtype=np.float32))
         x = np.empty(size, dtype=np.float32)
         y = np.empty(size, dtype=np.float32)
         z = np.empty(size, dtype=np.float32)
-        return Vec3(x,y,z)
+        return Vec3.wrap(x,y,z)
 
     @staticmethod
     def zeros(size):
+        if _layout == 'packed':
+            return PackedVec3(np.zeros(_packed_shape(size), dtype=np.float32))
         x = np.zeros(size, dtype=np.float32)
         y = np.zeros(size, dtype=np.float32)
         z = np.zeros(size, dtype=np.float32)
-        return Vec3(x,y,z)
+        return Vec3.wrap(x,y,z)
 
     @staticmethod
     def ones(size):
+        if _layout == 'packed':
+            return PackedVec3(np.ones(_packed_shape(size), dtype=np.float32))
         x = np.ones(size, dtype=np.float32)
         y = np.ones(size, dtype=np.float32)
         z = np.ones(size, dtype=np.float32)
-        return Vec3(x,y,z)
+        return Vec3.wrap(x,y,z)
     
     @staticmethod
     def where(condition, v1, v2):
+        if isinstance(v1, PackedVec3) and isinstance(v2, PackedVec3):
+            return PackedVec3(np.where(np.expand_dims(condition, -1), v1.data, v2.data))
         x = np.where(condition, v1.x, v2.x)
         y = np.where(condition, v1.y, v2.y)
         z = np.where(condition, v1.z, v2.z)
-        return Vec3(x,y,z)
+        return Vec3.wrap(x,y,z)
     
     def clip(self, vmin, vmax):
         x = np.clip(self.x, vmin, vmax)
         y = np.clip(self.y, vmin, vmax)
         z = np.clip(self.z, vmin, vmax)
-        return Vec3(x,y,z)
+        return Vec3.wrap(x,y,z)
 
     def fill(self, value):
         self.x.fill(value)
@@ -49,7 +93,7 @@ class Vec3:
         x = np.repeat(self.x, n)
         y = np.repeat(self.y, n)
         z = np.repeat(self.z, n)
-        return Vec3(x,y,z)
+        return Vec3.wrap(x,y,z)
     
     def __str__(self):
         return 'vec3: x:%s y:%s z:%s' % (str(self.x), str(self.y), str(self.z))
@@ -58,30 +102,80 @@ class Vec3:
         return self.x.size
 
     def __add__(self, other):
-        return Vec3(self.x + other.x, self.y + other.y, self.z + other.z)
+        return Vec3.wrap(self.x + other.x, self.y + other.y, self.z + other.z)
 
     def __sub__(self, other):
-        return Vec3(self.x - other.x, self.y - other.y, self.z - other.z)
+        return Vec3.wrap(self.x - other.x, self.y - other.y, self.z - other.z)
 
     def __neg__(self):
-        return Vec3(-self.x, -self.y, -self.z)
+        return Vec3.wrap(-self.x, -self.y, -self.z)
 
     def __mul__(self, scalar):
-        return Vec3(self.x*scalar, self.y*scalar, self.z*scalar)
+        return Vec3.wrap(self.x*scalar, self.y*scalar, self.z*scalar)
 
-    def multiply(self, other):
-        return Vec3(self.x * other.x, self.y * other.y, self.z * other.z)
+    def multiply(self, other, out=None):
+        '''Component-wise product'''
+        if out is None:
+            return Vec3.wrap(self.x * other.x, self.y * other.y, self.z * other.z)
+        np.multiply(self.x, other.x, out=out.x)
+        np.multiply(self.y, other.y, out=out.y)
+        np.multiply(self.z, other.z, out=out.z)
+        return out
 
     def __truediv__(self, scalar):
-        return Vec3(self.x/scalar, self.y/scalar, self.z/scalar)
+        return Vec3.wrap(self.x/scalar, self.y/scalar, self.z/scalar)
+
+    ## In-place operators, updating the component arrays without allocating
+    def __iadd__(self, other):
+        self.x += other.x
+        self.y += other.y
+        self.z += other.z
+        return self
+
+    def __isub__(self, other):
+        self.x -= other.x
+        self.y -= other.y
+        self.z -= other.z
+        return self
+
+    def __imul__(self, scalar):
+        self.x *= scalar
+        self.y *= scalar
+        self.z *= scalar
+        return self
+
+    def __itruediv__(self, scalar):
+        self.x /= scalar
+        self.y /= scalar
+        self.z /= scalar
+        return self
+
+    ## Variants of the operators writing into a preallocated vector
+    def add(self, other, out):
+        np.add(self.x, other.x, out=out.x)
+        np.add(self.y, other.y, out=out.y)
+        np.add(self.z, other.z, out=out.z)
+        return out
+
+    def subtract(self, other, out):
+        np.subtract(self.x, other.x, out=out.x)
+        np.subtract(self.y, other.y, out=out.y)
+        np.subtract(self.z, other.z, out=out.z)
+        return out
+
+    def scale(self, scalar, out):
+        np.multiply(self.x, scalar, out=out.x)
+        np.multiply(self.y, scalar, out=out.y)
+        np.multiply(self.z, scalar, out=out.z)
+        return out
     
     def tile(self, shape):
         '''Replicate np.tile on each component'''
-        return Vec3(np.tile(self.x, shape), np.tile(self.y, shape), np.tile(self.z, shape))
+        return Vec3.wrap(np.tile(self.x, shape), np.tile(self.y, shape), np.tile(self.z, shape))
 
     def __getitem__(self, idx):
-        '''Extract a vector subset'''
-        return Vec3(self.x[idx], self.y[idx], self.z[idx])
+        '''Extract a vector subset (a view for slices, as in numpy)'''
+        return Vec3.wrap(self.x[idx], self.y[idx], self.z[idx])
     
     def __setitem__(self, idx, other):
         '''Set a vector subset from another vector'''
@@ -92,6 +186,10 @@ class Vec3:
     def join(self):
         '''Join the three components into a single 3xN array'''
         return np.vstack((self.x, self.y, self.z))
+
+    def interleaved(self):
+        '''The components as a single Nx3 array, the layout images use'''
+        return np.stack((self.x, self.y, self.z), axis=-1)
     
     def append(self, other):
         '''Append another vector to this one.
@@ -102,24 +200,224 @@ class Vec3:
         self.z = np.concatenate((self.z, other.z))
         
 
+class PackedVec3(Vec3):
+    '''Vec3 stored as one contiguous (..., 3) array.
+
+    x, y and z are strided views of the single buffer, so a fancy index is
+    one gather instead of three and converting to an image needs no copy.
+    Operations between packed vectors (or with constants) work on the whole
+    buffer at once; anything else falls back to the planar Vec3 code.
+    '''
+    def __init__(self, data):
+        self.data = np.asarray(data, dtype=np.float32)
+
+    def _get_x(self):
+        return self.data[..., 0]
+
+    def _set_x(self, value):
+        self.data[..., 0] = value
+
+    def _get_y(self):
+        return self.data[..., 1]
+
+    def _set_y(self, value):
+        self.data[..., 1] = value
+
+    def _get_z(self):
+        return self.data[..., 2]
+
+    def _set_z(self, value):
+        self.data[..., 2] = value
+
+    x = property(_get_x, _set_x)
+    y = property(_get_y, _set_y)
+    z = property(_get_z, _set_z)
+
+    @staticmethod
+    def _packed(other):
+        # Buffer of other broadcastable against a packed buffer, or None
+        if isinstance(other, PackedVec3):
+            return other.data
+        if isinstance(other, Vec3) and other.x.ndim == 0:
+            return np.array([other.x, other.y, other.z], dtype=np.float32)
+        return None
+
+    @staticmethod
+    def _scalar(scalar):
+        # Per-vector scalars scale all three components of their vector
+        scalar = np.asarray(scalar, dtype=np.float32)
+        return scalar[..., None] if scalar.ndim else scalar
+
+    def clip(self, vmin, vmax):
+        return PackedVec3(np.clip(self.data, vmin, vmax))
+
+    def fill(self, value):
+        self.data.fill(value)
+
+    def __len__(self):
+        return self.data[..., 0].size
+
+    def __add__(self, other):
+        data = self._packed(other)
+        if data is None:
+            return super().__add__(other)
+        return PackedVec3(self.data + data)
+
+    def __sub__(self, other):
+        data = self._packed(other)
+        if data is None:
+            return super().__sub__(other)
+        return PackedVec3(self.data - data)
+
+    def __neg__(self):
+        return PackedVec3(-self.data)
+
+    def __mul__(self, scalar):
+        return PackedVec3(self.data * self._scalar(scalar))
+
+    def __truediv__(self, scalar):
+        return PackedVec3(self.data / self._scalar(scalar))
+
+    def multiply(self, other, out=None):
+        data = self._packed(other)
+        if data is None or (out is not None and not isinstance(out, PackedVec3)):
+            return super().multiply(other, out)
+        if out is None:
+            return PackedVec3(self.data * data)
+        np.multiply(self.data, data, out=out.data)
+        return out
+
+    def add(self, other, out):
+        data = self._packed(other)
+        if data is None or not isinstance(out, PackedVec3):
+            return super().add(other, out)
+        np.add(self.data, data, out=out.data)
+        return out
+
+    def subtract(self, other, out):
+        data = self._packed(other)
+        if data is None or not isinstance(out, PackedVec3):
+            return super().subtract(other, out)
+        np.subtract(self.data, data, out=out.data)
+        return out
+
+    def scale(self, scalar, out):
+        if not isinstance(out, PackedVec3):
+            return super().scale(scalar, out)
+        np.multiply(self.data, self._scalar(scalar), out=out.data)
+        return out
+
+    def __iadd__(self, other):
+        data = self._packed(other)
+        if data is None:
+            return super().__iadd__(other)
+        self.data += data
+        return self
+
+    def __isub__(self, other):
+        data = self._packed(other)
+        if data is None:
+            return super().__isub__(other)
+        self.data -= data
+        return self
+
+    def __imul__(self, scalar):
+        self.data *= self._scalar(scalar)
+        return self
+
+    def __itruediv__(self, scalar):
+        self.data /= self._scalar(scalar)
+        return self
+
+    def __getitem__(self, idx):
+        return PackedVec3(self.data[idx])
+
+    def __setitem__(self, idx, other):
+        data = self._packed(other)
+        if data is None:
+            super().__setitem__(idx, other)
+        else:
+            self.data[idx] = data
+
+    def join(self):
+        return self.data.T
+
+    def interleaved(self):
+        return self.data
+
+    def append(self, other):
+        data = self._packed(other)
+        if data is None:
+            data = other.interleaved()
+        self.data = np.concatenate((self.data, data))
+
+
 ## Aliases
 Point3 = Vec3
 Color = Vec3
 
+
+class Workspace:
+    '''Named scratch buffers, reused from one call to the next.
+
+    A buffer only grows, so once the largest batch has been seen the hot
+    loops stop allocating. The arrays returned are views into the buffers:
+    they are overwritten by the next request for the same name and must be
+    copied by callers that keep them.
+    '''
+    def __init__(self):
+        self._buffers = {}
+
+    def array(self, name, shape, dtype=np.float32):
+        size = int(np.prod(shape))
+        buffer = self._buffers.get((name, dtype))
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size, dtype=dtype)
+            self._buffers[(name, dtype)] = buffer
+        return buffer[:size].reshape(shape)
+
+    def vec3(self, name, shape):
+        if _layout == 'packed':
+            return PackedVec3(self.array(name, _packed_shape(shape)))
+        return Vec3.wrap(self.array(name + '.x', shape),
+                         self.array(name + '.y', shape),
+                         self.array(name + '.z', shape))
+
+# Scratch space shared by the hot loops of this process
+scratch = Workspace()
+
 ## Utility functions
-def unit_vector(v):
-    return v / length(v)
+# The out= variants write their result into preallocated arrays (a Vec3 for
+# unit_vector, a plain array for the others) instead of allocating.
+def unit_vector(v, out=None):
+    if out is None:
+        return v / length(v)
+    norm = length(v, out=scratch.array('unit_vector.norm', v.x.shape))
+    np.divide(v.x, norm, out=out.x)
+    np.divide(v.y, norm, out=out.y)
+    np.divide(v.z, norm, out=out.z)
+    return out
 
-def dot(a, b):
-    return a.x*b.x + a.y*b.y + a.z*b.z
+def dot(a, b, out=None):
+    if out is None:
+        return a.x*b.x + a.y*b.y + a.z*b.z
+    tmp = scratch.array('dot.tmp', out.shape)
+    np.multiply(a.x, b.x, out=out)
+    out += np.multiply(a.y, b.y, out=tmp)
+    out += np.multiply(a.z, b.z, out=tmp)
+    return out
 
-def length(v):
-    return length_squared(v)**0.5
+def length(v, out=None):
+    if out is None:
+        return length_squared(v)**0.5
+    return np.sqrt(length_squared(v, out=out), out=out)
 
-def length_squared(v):
-    return v.x*v.x + v.y*v.y + v.z*v.z
+def length_squared(v, out=None):
+    if out is None:
+        return v.x*v.x + v.y*v.y + v.z*v.z
+    return dot(v, v, out=out)
 
 def cross(a, b):
-    return Vec3(a.y*b.z - a.z*b.y,
-                -(a.x*b.z - a.z*b.x),
-                a.x*b.y - a.y*b.x)
+    return Vec3.wrap(a.y*b.z - a.z*b.y,
+                     -(a.x*b.z - a.z*b.x),
+                     a.x*b.y - a.y*b.x)
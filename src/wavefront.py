@@ -0,0 +1,187 @@
+'''Wavefront path tracing.
+
+color_materials traces a batch of camera rays bounce by bounce until the
+last path ends: the batch shrinks at every bounce, and the deep bounces
+pay the whole per-call overhead of NumPy for a few hundred rays. The
+wavefront engine keeps a pool of a fixed number of paths instead. Each
+step intersects and scatters every path of the pool once, whatever its
+depth; the paths that end hand their color to the accumulator and their
+slots are refilled with the camera rays of the next samples. Every step
+but the last few of a round runs on a full pool.
+
+The paths are shaded as color_materials would, so the engine only renders
+that shader.
+'''
+import numpy as np
+
+import profiler
+import sampling
+from accumulator import Engine
+from color import color_materials, gradient, scatter_hits, _roulette
+from hittable import HitRecord
+from material import material_table
+from ray import Ray
+from vec3 import Vec3
+
+class _SampleQueue:
+    # The samples still to trace of a round of work units, in order: all
+    # the pixels of the first sample of the first unit, then of its second
+    # sample...
+    def __init__(self, units):
+        self._batches = ((u, _pixel_array(unit.pixels), unit.key[1] + s)
+                         for u, unit in enumerate(units) for s in range(unit.n_samples))
+        self._batch = None
+        self._offset = 0
+
+    def take(self, n):
+        '''Up to n samples: the unit, pixel and sample index of each'''
+        units, pixels, samples = [], [], []
+        while n > 0:
+            if self._batch is None:
+                self._batch = next(self._batches, None)
+                self._offset = 0
+                if self._batch is None:
+                    break
+            u, batch_pixels, sample = self._batch
+            chunk = batch_pixels[self._offset:self._offset + n]
+            units.append(np.full(len(chunk), u, dtype=np.int32))
+            pixels.append(chunk)
+            samples.append(np.full(len(chunk), sample, dtype=np.int64))
+            self._offset += len(chunk)
+            n -= len(chunk)
+            if self._offset == len(batch_pixels):
+                self._batch = None
+        if not units:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(units), np.concatenate(pixels), np.concatenate(samples)
+
+def _pixel_array(pixels):
+    if isinstance(pixels, slice):
+        return np.arange(pixels.start, pixels.stop)
+    return pixels
+
+class WavefrontEngine(Engine):
+    '''Render work units in the current process through a fixed size pool
+    of paths, see the module documentation.
+
+    Each round (one run() call) draws from its own random stream, keyed by
+    the first sample of its units, so a seeded render is reproducible and
+    a resumed progressive render continues with the same streams. They are
+    not the streams of the other engines: the images are statistically
+    the same, not identical.
+    '''
+    def __init__(self, renderer, scene, ray_color):
+        if ray_color is not color_materials:
+            raise ValueError('the wavefront engine only renders color_materials, not %s'
+                             % getattr(ray_color, '__name__', ray_color))
+        settings = renderer.settings
+        if settings.workers > 1:
+            raise ValueError('the wavefront engine renders in a single process, use --workers 1')
+        super().__init__(settings)
+        self.renderer = renderer
+        self.settings = settings
+        self.scene = scene
+        self.table = material_table(scene)
+
+        # The live paths are kept at the front of the pool: the ray of their
+        # next bounce, what they carry so far, the pixel and unit of their
+        # sample and their number of bounces
+        size = settings.wavefront_size
+        self.rays = Ray(Vec3.empty(size), Vec3.empty(size))
+        self.throughput = Vec3.empty(size)
+        self.pixel = np.empty(size, dtype=np.int64)
+        self.unit = np.empty(size, dtype=np.int32)
+        self.depth = np.empty(size, dtype=np.int32)
+
+    def run(self, units, on_unit=None):
+        '''Render the units, on_unit(unit) is called as each completes'''
+        if not units:
+            return
+        sampling.seed(self.renderer._entropy, units[0].key[1], rng=self.settings.rng)
+        queue = _SampleQueue(units)
+        # Samples of each unit still to finish
+        remaining = np.array([len(_pixel_array(u.pixels)) * u.n_samples for u in units], dtype=np.int64)
+
+        n = self._refill(0, queue)
+        while n > 0:
+            n, ended = self._step(n)
+            if len(ended):
+                done_before = remaining == 0
+                np.subtract.at(remaining, ended, 1)
+                if on_unit:
+                    for u in np.flatnonzero((remaining == 0) & ~done_before):
+                        on_unit(units[u])
+            n = self._refill(n, queue)
+
+    def _refill(self, n, queue):
+        # Start the next samples in the free slots of the pool, returns the
+        # number of live paths
+        units, pixels, samples = queue.take(len(self.pixel) - n)
+        k = len(pixels)
+        if k == 0:
+            return n
+        new = slice(n, n + k)
+        self.rays[new] = self.renderer._camera_rays(pixels, samples)
+        self.throughput[new] = Vec3(1, 1, 1)
+        self.pixel[new] = pixels
+        self.unit[new] = units
+        self.depth[new] = 0
+        return n + k
+
+    def _step(self, n):
+        # One bounce of the n live paths. The paths that end are accumulated,
+        # the others are moved to the front of the pool. Returns their
+        # number and the units of the samples that ended.
+        settings = self.settings
+        profile = profiler.current()
+        rays = self.rays[:n]
+        hit_record = HitRecord(n)
+        with profile.section('update_hit_record'):
+            self.scene.update_hit_record(rays, 0.001, np.inf, hit_record)
+        if not self.table.types:
+            # Nothing to scatter off: every path sees the sky
+            self.accumulator.add_at(self.pixel[:n], gradient(rays, settings).multiply(self.throughput[:n]))
+            return 0, self.unit[:n].copy()
+
+        missed, rec, next_direction, attenuation, is_scattered = \
+            scatter_hits(rays, hit_record, self.table, profile)
+        # hit_record.index are the slots of the paths in the pool
+        slots = rec.index
+
+        with profile.section('accumulate'):
+            self.throughput[slots] = self.throughput[slots].multiply(attenuation)
+            depth = self.depth[slots] + 1
+
+        if settings.russian_roulette:
+            with profile.section('roulette'):
+                late = np.flatnonzero(depth >= settings.roulette_depth)
+                is_scattered[late] &= _roulette(self.throughput, slots[late])
+
+        with profile.section('compaction'):
+            # Paths end when they escape (lit by the sky), run out of bounces
+            # (lit by the sky in their last direction, as in color_materials)
+            # or are absorbed (black)
+            out_of_bounces = np.flatnonzero(is_scattered & (depth >= settings.max_depth))
+            lit = np.concatenate((missed, slots[out_of_bounces]))
+            directions = rays.direction[missed]
+            directions.append(next_direction[out_of_bounces])
+            absorbed = slots[~is_scattered]
+            ended_units = np.concatenate((self.unit[lit], self.unit[absorbed]))
+
+        with profile.section('shade'):
+            colors = gradient(Ray(None, directions), settings).multiply(self.throughput[lit])
+            colors.append(Vec3.zeros(len(absorbed)))
+        with profile.section('accumulate'):
+            self.accumulator.add_at(np.concatenate((self.pixel[lit], self.pixel[absorbed])), colors)
+
+        with profile.section('compaction'):
+            live = np.flatnonzero(is_scattered & (depth < settings.max_depth))
+            keep = slots[live]
+            m = len(live)
+            # Gather before writing: the kept paths move to the front
+            self.throughput[:m] = self.throughput[keep]
+            self.pixel[:m] = self.pixel[keep]
+            self.unit[:m] = self.unit[keep]
+            self.depth[:m] = depth[live]
+            self.rays[:m] = Ray(rec.p[live], next_direction[live])
+        return m, ended_units
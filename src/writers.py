@@ -0,0 +1,81 @@
+'''Image writers the renderer can output to directly.
+
+A writer is opened with the size of the frame, receives the pixels of
+every work unit as soon as they are rendered (write) and is closed with
+the final accumulator. The streaming writers keep the image in a
+memory-mapped file and store each unit's pixels at their offset, so the
+whole frame is never held in memory and a partial render is already on
+disk:
+
+    PPMWriter  8-bit gamma corrected binary PPM (.ppm)
+    NpyWriter  linear float32 colors as an (height, width, 3) .npy array,
+               for tone mapping or compositing later
+    PILWriter  any format PIL knows, written at the end (.png, .bmp, ...)
+'''
+import numpy as np
+
+class PILWriter:
+    def __init__(self, path):
+        self.path = path
+
+    def open(self, width, height):
+        self.shape = (height, width, 3)
+
+    def write(self, accumulator, pixels):
+        pass
+
+    def close(self, accumulator):
+        from PIL import Image
+        img = (accumulator.image().interleaved() * 255.999).astype(np.uint8)
+        Image.fromarray(img.reshape(self.shape)).save(self.path)
+
+class PPMWriter:
+    def __init__(self, path):
+        self.path = path
+
+    def open(self, width, height):
+        header = b'P6\n%d %d\n255\n' % (width, height)
+        with open(self.path, 'wb') as f:
+            f.write(header)
+            f.truncate(len(header) + width * height * 3)
+        # The pixels of a tile are consecutive: each write lands in one
+        # contiguous range of the file, after the header
+        self._pixels = np.memmap(self.path, dtype=np.uint8, mode='r+',
+                                 offset=len(header), shape=(width * height, 3))
+
+    def write(self, accumulator, pixels):
+        colors = accumulator.image(pixels=pixels)
+        self._pixels[pixels] = (colors.interleaved() * 255.999).astype(np.uint8)
+
+    def close(self, accumulator):
+        self._pixels.flush()
+        del self._pixels
+
+class NpyWriter:
+    def __init__(self, path):
+        self.path = path
+
+    def open(self, width, height):
+        self._array = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float32,
+                                                shape=(height, width, 3))
+        self._pixels = self._array.reshape(width * height, 3)
+
+    def write(self, accumulator, pixels):
+        self._pixels[pixels] = accumulator.mean(pixels).interleaved()
+
+    def close(self, accumulator):
+        self._array.flush()
+        del self._pixels, self._array
+
+# Writer of each file extension, PILWriter for the others
+WRITERS = {
+    '.ppm': PPMWriter,
+    '.npy': NpyWriter,
+}
+
+def get_writer(path):
+    '''The writer of path, chosen from its extension'''
+    for extension, writer in WRITERS.items():
+        if path.lower().endswith(extension):
+            return writer(path)
+    return PILWriter(path)